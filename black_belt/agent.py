@@ -1,11 +1,13 @@
 import random
-import pickle
 
 import numpy
 
-from black_belt.bodega_brawl import State, Action, action_order
-from black_belt.game_statistics import state_to_index, payoff_matrix
-from black_belt.ne import best_response
+from black_belt import packed_state
+from black_belt.bodega_brawl import (
+    Action, action_order, default_config, game_configs)
+from black_belt.game_statistics import game_tables
+from black_belt.solution_file import load_solution
+from black_belt.mcts import MCTSTree, RootParallelSearch
 
 class Agent:
     def play(self, state):
@@ -13,21 +15,109 @@ class Agent:
         policy = self.policy(state)
         weights = [policy[int(a)] for a in my_actions]
         return random.choices(my_actions, weights=weights)[0]
+    
+    def policies(self, indices, tables):
+        '''
+        Returns the policies for an array of N state indices as an (N,9)
+        array.  Agents backed by tables override this with a vectorized
+        lookup, the default calls policy once per state.
+        '''
+        return numpy.array([
+            self.policy(tables.index_to_state(int(i))) for i in indices],
+            dtype=numpy.float64,
+        ).reshape(-1, 9)
+
+def evaluate(agent, opponent, config=None, successors=None):
+    '''
+    Computes the exact probabilities that agent wins, draws and loses against
+    opponent from the start of the game, without playing any games.  Both
+    agents must be stationary, so their policies may only depend on the
+    state.  Agents backed by tables make this a vectorized backward pass over
+    the game.
+    '''
+    tables = game_tables(config)
+    outcomes = tables.outcome_probabilities(
+        lambda indices : agent.policies(indices, tables),
+        lambda indices : opponent.policies(indices, tables),
+        successors=successors,
+    )
+    return outcomes[tables.state_to_index(tables.config.initial_state())]
 
 class SolvedAgent(Agent):
-    def __init__(self, path):
-        with open(path, 'rb') as f:
-            self.data = pickle.load(f)
+    '''
+    Plays a solution, loaded from path or given directly as solution (such
+    as one attached from a shared_solution.SharedSolution).
+    '''
+    def __init__(self, path=None, config=None, solution=None):
+        if solution is None:
+            if path is None:
+                if config is None:
+                    config = default_config
+                path = './solutions/%s_final.b4s'%config.name
+            solution = load_solution(path, config=config)
+        self.path = solution.path
+        self.solution = solution
+        self.config = self.solution.config
+        self.tables = self.solution.tables
+        self.values = self.solution.values
 
     def policy(self, state):
-        index = state_to_index(state)
-        policy = self.data['p'][index]
+        index = self.tables.state_to_index(state)
+        policy = self.solution.policy(index)
         return policy
     
     def value(self, state):
-        index = state_to_index(state)
-        value = self.data['v'][index]
+        index = self.tables.state_to_index(state)
+        value = self.solution.value(index)
         return value
+    
+    def policies(self, indices, tables):
+        return self.solution.policy(indices)
+
+class PolicyServerAgent(Agent):
+    '''
+    Plays the solution served by a running b4_policy_server at address (see
+    policy_server.py) instead of loading it, so that many processes can share
+    a single copy.  It can be used anywhere a SolvedAgent is used to play.
+    Call close to disconnect.
+    '''
+    def __init__(self, address=None, config=None):
+        # the client pulls in socket handling, which b4_play does not need
+        # unless it is playing through a server
+        from black_belt.policy_server import PolicyClient, default_address
+        if address is None:
+            address = default_address
+        self.client = PolicyClient(address)
+        game_mode = self.client.request('info')['game_mode']
+        if config is None:
+            config = game_configs[game_mode]
+        elif config.name != game_mode:
+            raise ValueError('the policy server is serving the %s game'%(
+                game_mode))
+        self.config = config
+        self.tables = game_tables(config)
+    
+    def play(self, state):
+        actions = self.client.request('sample', [state.serialize()])
+        return action_order[actions['actions'][0]]
+    
+    def policy(self, state):
+        policies = self.client.request('policy', [state.serialize()])
+        return numpy.array(policies['policies'][0])
+    
+    def value(self, state):
+        return self.client.request('value', [state.serialize()])['values'][0]
+    
+    def policies(self, indices, tables):
+        states = [
+            ','.join(row) for row in
+            tables.indices_to_states(indices).astype(str).tolist()
+        ]
+        policies = self.client.request('policy', states)['policies']
+        return numpy.array(policies, dtype=numpy.float64).reshape(-1, 9)
+    
+    def close(self):
+        self.client.close()
 
 class RandomAgent(Agent):
     def policy(self, state):
@@ -36,23 +126,64 @@ class RandomAgent(Agent):
         for a in my_actions:
             policy[int(a)] = 1./len(my_actions)
         return policy
+    
+    def policies(self, indices, tables):
+        masks, _ = tables.action_masks(indices)
+        return masks / masks.sum(axis=1, keepdims=True)
 
 class BestResponseAgent(Agent):
-    def __init__(self, opponent):
+    '''
+    Plays a best response to a solved opponent.  Each move is chosen from a
+    payoff matrix built from the opponent's values, unless table is given.
+    That should be the path of a best response table saved by
+    b4_best_response, and each move is then looked up in it instead.
+
+    These are two different agents.  Without a table, each move is a
+    one-step best response to the opponent's current policy that scores
+    the next states with the opponent's equilibrium values, as if both
+    players went back to the equilibrium afterward.  The table holds the
+    full best response, which is computed backward from the end of the
+    game and scores the next states by what it will go on to win against
+    the opponent.  It is never worse against the opponent and can be
+    better.
+    '''
+    def __init__(self, opponent, successors=None, table=None):
         self.opponent = opponent
+        self.successors = successors
+        self.table = None
+        if table is not None:
+            self.table = load_solution(table, config=opponent.config)
     
     def policy(self, state):
-        my_actions, opponent_actions = state.action_space
-        opposite_state = State(state.p2, state.p1)
-        game, _ = payoff_matrix(state, self.opponent.data['v'])
-        opponent_policy = self.opponent.policy(opposite_state)
-        partial_opponent_policy = opponent_policy[
-            [int(a) for a in opponent_actions]]
-        partial_policy, v = best_response(game, partial_opponent_policy)
-        policy = [0.] * 9
-        for i,a in enumerate(my_actions):
-            policy[int(a)] = partial_policy[i]
-        return policy
+        if self.table is not None:
+            return self.table.policy(self.table.tables.state_to_index(state))
+        
+        # go through policies so that ties are broken the same way as in
+        # simulate and evaluate
+        tables = self.opponent.tables
+        return self.policies([tables.state_to_index(state)], tables)[0]
+    
+    def policies(self, indices, tables):
+        if self.table is not None:
+            return self.table.policy(indices)
+        
+        indices = numpy.asarray(indices, dtype=numpy.int64)
+        games = tables.payoff_matrices(
+            indices, self.opponent.values, self.successors)
+        opponent_policies = self.opponent.policies(
+            tables.mirror_indices(indices), tables)
+        
+        # pick the first action with the best expected payoff, the same as
+        # ne.best_response, but treat payoffs within round-off of the best as
+        # ties so the choice does not depend on how the states were batched
+        illegal = numpy.isnan(games)
+        expected = numpy.einsum(
+            'nj,nji->ni', opponent_policies, numpy.nan_to_num(games))
+        expected[illegal.all(axis=1)] = -numpy.inf
+        best = expected >= expected.max(axis=1, keepdims=True) - 1e-12
+        policies = numpy.zeros((len(indices), 9))
+        policies[numpy.arange(len(indices)), best.argmax(axis=1)] = 1.
+        return policies
 
 class ArgmaxCounterAgent(Agent):
     def __init__(self, opponent):
@@ -61,8 +192,8 @@ class ArgmaxCounterAgent(Agent):
     
     def policy(self, state):
         my_actions, opponent_actions = state.action_space
-        opposite_state = State(state.p2, state.p1)
-        opponent_policy = self.opponent.play(opposite_state)
+        opposite_state = state.mirror()
+        opponent_policy = self.opponent.policy(opposite_state)
         opponent_index = numpy.argmax(opponent_policy)
         opponent_action = action_order[opponent_index]
         if opponent_action.mode == 'attack':
@@ -72,10 +203,11 @@ class ArgmaxCounterAgent(Agent):
                 policy[int(action)] = 1.
                 return policy
         
+        config = state.config
         region_priorities = sorted([
-            (2 - state.p2.hit_state.head, 'head'),
-            (3 - state.p2.hit_state.body, 'body'),
-            (4 - state.p2.hit_state.legs, 'legs')
+            (config.max_head_hits - state.p2.hit_state.head, 'head'),
+            (config.max_body_hits - state.p2.hit_state.body, 'body'),
+            (config.max_legs_hits - state.p2.hit_state.legs, 'legs')
         ])
         for hits_remaining, region in region_priorities:
             card_state = state.p1.card_state
@@ -92,90 +224,78 @@ class ArgmaxCounterAgent(Agent):
         
         return self.random_agent.policy(state)
 
-class MCTSNode:
-    def __init__(self, state, c=2**0.5, child_nodes=None):
-        self.state = state
-        self.c = c
-        self.visits = 0
-        self.my_actions, self.opponent_actions = state.action_space
-        self.my_child_visits = numpy.zeros(len(self.my_actions))
-        self.my_child_values = numpy.zeros(len(self.my_actions))
-        self.opponent_child_visits = numpy.zeros(len(self.opponent_actions))
-        self.opponent_child_values = numpy.zeros(len(self.opponent_actions))
-        self.opponent_visits = 0
-        if child_nodes is None:
-            child_nodes = {}
-        self.child_nodes = child_nodes
-        self.random_agent = RandomAgent()
-        
-    def sample(self):
-        my_unsampled_children = numpy.where(self.my_child_visits == 0)[0]
-        if my_unsampled_children.shape[0]:
-            my_child_index = random.choice(my_unsampled_children)
-            my_action = self.my_actions[my_child_index]
-        else:
-            my_ucb = (
-                (self.my_child_values / self.my_child_visits) +
-                self.c * (numpy.log(self.visits)/self.my_child_visits)
+class MCTSAgent(Agent):
+    '''
+    Picks each move with a Monte Carlo tree search (see mcts.py).  The tree
+    is kept between moves and games, so later searches build on earlier
+    ones.  If seconds is given, each move is searched for that long instead
+    of for a fixed number of samples.
+
+    With num_procs greater than one, each move is searched in parallel in
+    num_procs worker processes (see mcts.RootParallelSearch), and the agent
+    plays the action with the most visits across all of them.  Call close
+    to stop the workers when the agent is no longer needed.
+
+    rollout_depth and evaluator cut the rollouts short and score the state
+    they stop in instead (see mcts.make_evaluator).
+    '''
+    def __init__(
+        self,
+        samples=10000,
+        config=None,
+        c=2**0.5,
+        num_procs=1,
+        seconds=None,
+        seed=None,
+        rollout_depth=None,
+        evaluator=None,
+    ):
+        self.samples = None if seconds is not None else samples
+        self.seconds = seconds
+        self.tree = None
+        self.parallel_search = None
+        if num_procs > 1:
+            self.parallel_search = RootParallelSearch(
+                num_procs,
+                config=config,
+                c=c,
+                seed=seed,
+                rollout_depth=rollout_depth,
+                evaluator=evaluator,
             )
-            my_child_index = numpy.argmax(my_ucb)
-            my_action = self.my_actions[my_child_index]
-        self.my_child_visits[my_child_index] += 1
-            
-        opponent_unsampled_children = numpy.where(
-            self.opponent_child_visits == 0)[0]
-        if opponent_unsampled_children.shape[0]:
-            opponent_child_index = random.choice(opponent_unsampled_children)
-            opponent_action = self.opponent_actions[opponent_child_index]
+            self.config = game_tables(config).config
         else:
-            opponent_ucb = (
-                (1.-self.opponent_child_values / self.opponent_child_visits) +
-                self.c * (numpy.log(self.visits)/self.opponent_child_visits)
+            rng = None if seed is None else random.Random(seed)
+            self.tree = MCTSTree(
+                config,
+                c=c,
+                rng=rng,
+                rollout_depth=rollout_depth,
+                evaluator=evaluator,
             )
-            opponent_child_index = numpy.argmax(opponent_ucb)
-            opponent_action = self.opponent_actions[opponent_child_index]
-        self.opponent_child_visits[opponent_child_index] += 1
-        self.visits += 1
-        
-        next_state = self.state.transition((my_action, opponent_action))
-        if next_state.terminal:
-            value = next_state.value
-        
-        elif next_state in self.child_nodes:
-            value, _, _ = self.child_nodes[next_state].sample()
-        
-        else:
-            self.child_nodes[next_state] = MCTSNode(
-                next_state, c=self.c, child_nodes=self.child_nodes)
-            while not next_state.terminal:
-                my_next_actions, opponent_next_actions = next_state.action_space
-                my_next_action = random.choice(my_next_actions)
-                opponent_next_action = random.choice(opponent_next_actions)
-                next_state = next_state.transition(
-                    (my_next_action, opponent_next_action))
-            
-            value = next_state.value
-        
-        self.my_child_values[my_child_index] += value
-        self.opponent_child_values[opponent_child_index] += value
+            self.config = self.tree.config
+    
+    def search(self, code):
+        if self.parallel_search is None:
+            return self.tree.search(code, self.samples, self.seconds)
         
-        return value, my_action, opponent_action
-
-class MCTSAgent(Agent):
-    def __init__(self, samples=10000):
-        self.samples = samples
-        self.mcts_nodes = {}
-        self.root_node = MCTSNode(State(), child_nodes=self.mcts_nodes)
-        self.mcts_nodes[State()] = self.root_node
+        _, visits, _ = self.parallel_search.search(
+            code, self.samples, self.seconds)
+        return visits.index(max(visits))
     
     def policy(self, state):
-        if state not in self.mcts_nodes:
-            self.mcts_nodes[state] = MCTSNode(
-                state, child_nodes=self.mcts_nodes)
-        mcts_node = self.mcts_nodes[state]
-        for i in range(self.samples):
-            mcts_node.sample()
-        v, my_action, _ = mcts_node.sample()
+        action = self.search(packed_state.pack_state(state))
         my_policy = [0.] * 9
-        my_policy[int(my_action)] = 1.
+        my_policy[action] = 1.
         return my_policy
+    
+    def policies(self, indices, tables):
+        codes = tables.indices_to_codes(indices)
+        policies = numpy.zeros((len(codes), 9))
+        for n, code in enumerate(codes.tolist()):
+            policies[n, self.search(code)] = 1.
+        return policies
+    
+    def close(self):
+        if self.parallel_search is not None:
+            self.parallel_search.close()
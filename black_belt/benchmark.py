@@ -0,0 +1,285 @@
+import os
+import sys
+import json
+import time
+import random
+import platform
+import tempfile
+import argparse
+import contextlib
+
+import numpy
+
+from black_belt.bodega_brawl import game_configs
+from black_belt.game_statistics import game_tables
+from black_belt.ne import lp_solve_zero_sum, batch_lp_solve_zero_sum
+from black_belt.agent import (
+    SolvedAgent,
+    RandomAgent,
+    BestResponseAgent,
+    ArgmaxCounterAgent,
+    MCTSAgent,
+)
+from black_belt.mcts import MCTSTree
+from black_belt.packed_state import pack_state
+from black_belt.solve import solve
+
+'''
+Times the hot paths of the engine so that changes that slow down the solver
+or the agents can be caught before they are merged.  Each benchmark reports
+the number of seconds a single call takes (or a single state, game or MCTS
+sample for the batched benchmarks), keeping the fastest of several repeats,
+which is the least affected by whatever else the machine is doing.
+
+The state and solver benchmarks run on a fixed random sample of the states
+of --mode.  The solve benchmarks solve the tiny and small games from scratch
+in a temporary directory, and the agents are then timed on the small game
+using that solution, so the suite needs no files to already exist.
+
+Results are compared to a json baseline saved on the same machine with
+--save.  Any benchmark that has slowed down by more than --threshold (a
+fraction of the baseline) is reported as a regression, and
+b4_benchmark then exits with a non-zero status.
+'''
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--mode', type=str, default='medium', choices=tuple(game_configs),
+    help='The game configuration used for the state and solver benchmarks.')
+parser.add_argument(
+    '--baseline', type=str, default='./benchmark_baseline.json',
+    help='The baseline to compare against, or to write with --save.')
+parser.add_argument(
+    '--save', action='store_true',
+    help='Save the results as the new baseline instead of comparing them.')
+parser.add_argument(
+    '--threshold', type=float, default=0.25,
+    help='Fail if a benchmark is more than this fraction slower than the '
+    'baseline.')
+parser.add_argument(
+    '--only', type=str, nargs='+', default=None,
+    help='Only run the benchmarks whose names start with one of these.')
+parser.add_argument('--repeats', type=int, default=5)
+parser.add_argument(
+    '--samples', type=int, default=256,
+    help='The number of states sampled for the state and solver benchmarks.')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument(
+    '--output', type=str, default=None,
+    help='Write the results and the comparison to this json file.')
+
+def measure(function, items, repeats=5):
+    '''
+    Calls function on each of items, repeats times over, and returns the
+    fastest average time per item.
+    '''
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for item in items:
+            function(item)
+        best = min(best, (time.perf_counter() - start) / len(items))
+    return best
+
+def measure_batch(function, batch, size, repeats=5):
+    '''
+    Calls function once on a batch of size items, repeats times over, and
+    returns the fastest time per item.
+    '''
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(batch)
+        best = min(best, (time.perf_counter() - start) / size)
+    return best
+
+@contextlib.contextmanager
+def working_directory(path):
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+def state_benchmarks(config, samples, repeats, rng):
+    tables = game_tables(config)
+    indices = rng.choice(tables.total_states, size=samples, replace=False)
+    states = [tables.index_to_state(int(i)) for i in indices]
+    moves = []
+    for state in states:
+        p1_actions, p2_actions = state.action_space
+        moves.append((
+            state,
+            (p1_actions[rng.integers(len(p1_actions))],
+            p2_actions[rng.integers(len(p2_actions))]),
+        ))
+    value = rng.random(tables.total_states, dtype=numpy.float32)
+    games = [tables.payoff_matrix(state, value)[0] for state in states]
+    payoffs = tables.payoff_matrices(indices, value)
+    illegal = numpy.isnan(payoffs)
+
+    yield 'state_transition', lambda : measure(
+        lambda m : m[0].transition(m[1]), moves, repeats)
+    yield 'state_to_index', lambda : measure(
+        tables.state_to_index, states, repeats)
+    yield 'index_to_state', lambda : measure(
+        tables.index_to_state, indices.tolist(), repeats)
+    yield 'payoff_matrix', lambda : measure(
+        lambda s : tables.payoff_matrix(s, value), states, repeats)
+    yield 'payoff_matrices', lambda : measure_batch(
+        lambda i : tables.payoff_matrices(i, value), indices, samples, repeats)
+    yield 'lp_solve_zero_sum', lambda : measure(
+        lp_solve_zero_sum, games, repeats)
+    yield 'batch_lp_solve_zero_sum', lambda : measure_batch(
+        lambda g : batch_lp_solve_zero_sum(
+            g, row_mask=~illegal.all(axis=2), col_mask=~illegal.all(axis=1)),
+        payoffs,
+        samples,
+        repeats,
+    )
+
+def mcts_benchmarks(config, repeats, samples=2000):
+    code = pack_state(config.initial_state())
+    def run(_):
+        tree = MCTSTree(config, rng=random.Random(0))
+        tree.run(tree.node(code), samples=samples)
+    yield 'mcts_sample', lambda : measure_batch(run, None, samples, repeats)
+
+def solve_benchmarks(repeats):
+    def run(mode):
+        best = float('inf')
+        for _ in range(repeats):
+            start = time.perf_counter()
+            solve(game_configs[mode], num_procs=1)
+            best = min(best, time.perf_counter() - start)
+        return best
+    for mode in ('tiny', 'small'):
+        yield 'solve_%s'%mode, lambda mode=mode : run(mode)
+
+def agent_benchmarks(config, samples, repeats, rng):
+    tables = game_tables(config)
+    indices = rng.choice(tables.total_states, size=samples, replace=False)
+    states = [tables.index_to_state(int(i)) for i in indices]
+    solved = SolvedAgent(config=config)
+    agents = {
+        'random' : RandomAgent(),
+        'solved' : solved,
+        'best_response' : BestResponseAgent(solved),
+        'argmax_counter' : ArgmaxCounterAgent(solved),
+    }
+    for name, agent in agents.items():
+        yield 'play_%s'%name, lambda agent=agent : measure(
+            agent.play, states, repeats)
+
+    # a fresh tree for each repeat so that it does not build on earlier moves
+    def play_mcts():
+        return min(
+            measure(MCTSAgent(100, config=config, seed=0).play, states[:16], 1)
+            for _ in range(repeats)
+        )
+    yield 'play_mcts', play_mcts
+
+def run_benchmarks(
+    config=None,
+    samples=256,
+    repeats=5,
+    seed=0,
+    only=None,
+):
+    '''
+    Runs the benchmarks and returns a dict mapping each name to its time in
+    seconds.
+    '''
+    if config is None:
+        config = game_configs['medium']
+    rng = numpy.random.default_rng(seed)
+    random.seed(seed)
+    def wanted(name):
+        return only is None or any(name.startswith(o) for o in only)
+
+    # each benchmark is a name and a function that runs it, so that the ones
+    # that were not asked for can be skipped
+    results = {}
+    def record(benchmarks):
+        for name, run in benchmarks:
+            if wanted(name):
+                results[name] = run()
+                print('%s: %.03e s'%(name, results[name]))
+    if only is None or any(not o.startswith(('solve', 'play')) for o in only):
+        record(state_benchmarks(config, samples, repeats, rng))
+        record(mcts_benchmarks(config, repeats))
+    with tempfile.TemporaryDirectory() as path, working_directory(path):
+        record(solve_benchmarks(repeats))
+        if only is None or any(o.startswith('play') for o in only):
+            small = game_configs['small']
+            if not os.path.exists('./solutions/small_final.b4s'):
+                solve(small, num_procs=1)
+            record(agent_benchmarks(small, samples, repeats, rng))
+    return results
+
+def compare(results, baseline, threshold=0.25):
+    '''
+    Compares results with the baseline results and returns a dict with the
+    ratio of each time to its baseline and the names that slowed down by
+    more than threshold.
+    '''
+    ratios = {
+        name : seconds / baseline[name]
+        for name, seconds in results.items()
+        if baseline.get(name)
+    }
+    regressions = [
+        name for name, ratio in ratios.items() if ratio > 1. + threshold]
+    return {'ratios' : ratios, 'regressions' : regressions}
+
+def benchmark_commandline():
+    args = parser.parse_args()
+    results = run_benchmarks(
+        config=game_configs[args.mode],
+        samples=args.samples,
+        repeats=args.repeats,
+        seed=args.seed,
+        only=args.only,
+    )
+    report = {
+        'game_mode' : args.mode,
+        'samples' : args.samples,
+        'python' : platform.python_version(),
+        'machine' : platform.platform(),
+        'results' : results,
+    }
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Saved baseline to %s'%args.baseline)
+        return
+
+    regressions = []
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['game_mode'] != args.mode:
+            raise ValueError('the baseline was run with --mode %s'%(
+                baseline['game_mode']))
+        comparison = compare(results, baseline['results'], args.threshold)
+        report.update(comparison)
+        regressions = comparison['regressions']
+        for name, ratio in comparison['ratios'].items():
+            print('%s: %.02fx baseline%s'%(
+                name, ratio, ' REGRESSION' if name in regressions else ''))
+    else:
+        print('No baseline at %s, run with --save to create one'%(
+            args.baseline))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if regressions:
+        print('%i benchmarks regressed by more than %.0f%%: %s'%(
+            len(regressions), 100. * args.threshold, ', '.join(regressions)))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    benchmark_commandline()
@@ -0,0 +1,108 @@
+import os
+import argparse
+
+import numpy
+
+from black_belt.bodega_brawl import game_mode, game_configs
+from black_belt.game_statistics import load_successor_table
+from black_belt.solution_file import (
+    quantization_dtypes,
+    create_solution,
+    open_solution_arrays,
+    write_solution_chunk,
+    write_header,
+)
+from black_belt.agent import SolvedAgent
+
+'''
+Precomputes a best response to a solved agent for every state and saves it in
+the solution file format, so that BestResponseAgent can play it with a single
+lookup per move instead of building payoff matrices as it goes.  The values
+stored in the file are the exact values of the best response against the
+solved agent (see GameTables.best_response_values), and the policies are
+pure, putting all of their probability on one action.
+
+The file is saved as solutions/<mode>_best_response.b4s by default and can be
+used with the --best-response-table flag of b4_test_solve and b4_tournament.
+'''
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--mode', type=str, default=game_mode, choices=tuple(game_configs),
+    help='The game configuration of the solution.')
+parser.add_argument(
+    '--opponent', type=str, default=None,
+    help='The solution to respond to.  Defaults to '
+    'solutions/<mode>_final.b4s.')
+parser.add_argument(
+    '--output', type=str, default=None,
+    help='Where to save the table.  Defaults to '
+    'solutions/<mode>_best_response.b4s.')
+parser.add_argument(
+    '--dtype', type=str, default='float64', choices=quantization_dtypes,
+    help='How to store the values and policies.')
+parser.add_argument(
+    '--successor-table', action='store_true',
+    help='Use the precomputed successor table.')
+
+def best_response_path(config):
+    return './solutions/%s_best_response.b4s'%config.name
+
+def build_best_response(
+    opponent_path=None,
+    path=None,
+    config=None,
+    dtype='float64',
+    successor_table=False,
+    chunk_size=2**20,
+):
+    opponent = SolvedAgent(opponent_path, config=config)
+    config = opponent.config
+    tables = opponent.tables
+    if path is None:
+        path = best_response_path(config)
+
+    successors = None
+    if successor_table:
+        successors = load_successor_table(
+            './solutions/%s_successors.npy'%config.name)
+
+    value, _, actions = tables.best_response_values(
+        opponent.solution.policy, successors=successors)
+
+    # write to a temporary file first so a partial table is never loaded
+    work_path = path + '.partial'
+    header = create_solution(work_path, config=config, dtype=dtype)
+    arrays = open_solution_arrays(work_path, header, mode='r+')
+    for start in range(0, tables.total_states, chunk_size):
+        end = min(start + chunk_size, tables.total_states)
+        policy = numpy.zeros((end - start, 9))
+        policy[numpy.arange(end - start), actions[start:end]] = 1.
+        value_error, policy_error = write_solution_chunk(
+            arrays, header, numpy.arange(start, end), value[start:end], policy)
+        header['max_value_error'] = max(
+            header['max_value_error'], value_error)
+        header['max_policy_error'] = max(
+            header['max_policy_error'], policy_error)
+    for array in arrays.values():
+        array.flush()
+    header['best_response_to'] = os.path.basename(opponent.path)
+    write_header(work_path, header)
+    os.replace(work_path, path)
+
+    root = tables.state_to_index(config.initial_state())
+    print('Saved %s, Best Response Value: %.09f'%(path, value[root]))
+    return path
+
+def best_response_commandline():
+    args = parser.parse_args()
+    build_best_response(
+        opponent_path=args.opponent,
+        path=args.output,
+        config=game_configs[args.mode],
+        dtype=args.dtype,
+        successor_table=args.successor_table,
+    )
+
+if __name__ == '__main__':
+    best_response_commandline()
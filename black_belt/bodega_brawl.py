@@ -2,62 +2,87 @@ from collections import namedtuple
 
 '''
 This module implements all the functionality of the Bodega Brawl game.
-The game_mode constant was for debugging purposes, and allowed me to build
-smaller versions of the game with different win conditions and starting numbers
-of cards.  The 'large' setting is for the default game.
+The rules of the game are described by a GameConfig.  The smaller variants in
+game_configs were for debugging purposes, and allowed me to build smaller
+versions of the game with different win conditions and starting numbers of
+cards.  The 'large' setting is for the default game.  The game_mode constant
+picks the default configuration used when no other is given.
 '''
 
-game_mode = 'large' # 'large' 'medium' 'small' or 'tiny'
+class GameConfig(namedtuple('GameConfig', (
+    'name',
+    'max_head_hits',
+    'max_body_hits',
+    'max_legs_hits',
+    'max_total_hits',
+    'start_cards',
+    'payoffs',
+))):
+    '''
+    The rules of one variant of the game.  start_cards is the number of each
+    card type a player starts with, in the same order as the CardState
+    fields.  payoffs is the value of a terminal state for p1 when p1 wins,
+    when p2 wins and when the game is a draw.
+    '''
+    @property
+    def symmetric(self):
+        '''
+        True when swapping the players turns every value v into 1 - v.
+        '''
+        win, loss, draw = self.payoffs
+        return win + loss == 1. and draw == 0.5
+    
+    @property
+    def types(self):
+        return game_types(self)
+    
+    def initial_state(self):
+        return self.types.State()
 
-if game_mode == 'large':
-    max_head_hits = 2
-    max_body_hits = 3
-    max_legs_hits = 4
-    max_total_hits = 5
-elif game_mode == 'medium':
-    max_head_hits = 2
-    max_body_hits = 3
-    max_legs_hits = 3
-    max_total_hits = 4
-elif game_mode == 'small':
-    max_head_hits = 2
-    max_body_hits = 2
-    max_legs_hits = 2
-    max_total_hits = 3
-elif game_mode == 'tiny':
-    max_head_hits = 1
-    max_body_hits = 2
-    max_legs_hits = 2
-    max_total_hits = 2
+# the value of a terminal state for p1 when p1 wins, p2 wins or they draw
+standard_payoffs = (0.9, 0.1, 0.5)
 
-if game_mode == 'large':
-    start_head_a = 1
-    start_head_ac = 3
-    start_body_a = 1
-    start_body_ac = 4
-    start_legs_a = 1
-    start_legs_ac = 4
-elif game_mode == 'medium':
-    start_head_a = 1
-    start_head_ac = 2
-    start_body_a = 1
-    start_body_ac = 2
-    start_legs_a = 1
-    start_legs_ac = 2
-elif game_mode == 'small':
-    start_head_a = 0
-    start_head_ac = 2
-    start_body_a = 0
-    start_body_ac = 2
-    start_legs_a = 0
-    start_legs_ac = 2
-elif game_mode == 'tiny':
-    start_head_a = 0
-    start_head_ac = 1
-    start_body_a = 0
-    start_body_ac = 2
-    start_legs_a = 0
-    start_legs_ac = 0
+game_configs = {
+    'large' : GameConfig(
+        name='large',
+        max_head_hits=2,
+        max_body_hits=3,
+        max_legs_hits=4,
+        max_total_hits=5,
+        start_cards=(1, 3, 1, 4, 1, 4),
+        payoffs=standard_payoffs,
+    ),
+    'medium' : GameConfig(
+        name='medium',
+        max_head_hits=2,
+        max_body_hits=3,
+        max_legs_hits=3,
+        max_total_hits=4,
+        start_cards=(1, 2, 1, 2, 1, 2),
+        payoffs=standard_payoffs,
+    ),
+    'small' : GameConfig(
+        name='small',
+        max_head_hits=2,
+        max_body_hits=2,
+        max_legs_hits=2,
+        max_total_hits=3,
+        start_cards=(0, 2, 0, 2, 0, 2),
+        payoffs=standard_payoffs,
+    ),
+    'tiny' : GameConfig(
+        name='tiny',
+        max_head_hits=1,
+        max_body_hits=2,
+        max_legs_hits=2,
+        max_total_hits=2,
+        start_cards=(0, 1, 0, 2, 0, 0),
+        payoffs=standard_payoffs,
+    ),
+}
+
+game_mode = 'large' # 'large' 'medium' 'small' or 'tiny'
+default_config = game_configs[game_mode]
 
 class Action(namedtuple('Action', ('region', 'card', 'mode'))):
     '''
@@ -117,6 +142,8 @@ class HitState(namedtuple(
     '''
     Defines how many times each body part has been hit by the opponent.
     '''
+    config = default_config
+    
     @property
     def total(self):
         return sum(self)
@@ -124,10 +151,10 @@ class HitState(namedtuple(
     @property
     def is_dead(self):
         return (
-            self.head >= max_head_hits or
-            self.body >= max_body_hits or
-            self.legs >= max_legs_hits or
-            self.total >= max_total_hits
+            self.head >= self.config.max_head_hits or
+            self.body >= self.config.max_body_hits or
+            self.legs >= self.config.max_legs_hits or
+            self.total >= self.config.max_total_hits
         )
     
     def transition(self, actions):
@@ -157,18 +184,13 @@ class HitState(namedtuple(
 class CardState(namedtuple(
     'CardState',
     ('head_a', 'head_ac', 'body_a', 'body_ac', 'legs_a', 'legs_ac'),
-    defaults=(
-        start_head_a,
-        start_head_ac,
-        start_body_a,
-        start_body_ac,
-        start_legs_a,
-        start_legs_ac,
-    ),
+    defaults=default_config.start_cards,
 )):
     '''
     Defines how many of each card type a player has left.
     '''
+    config = default_config
+    
     @property
     def action_space(self):
         action_space = []
@@ -212,8 +234,10 @@ class PlayerState(namedtuple(
     '''
     Contains a HitState and CardState to define the state for a single player.
     '''
+    config = default_config
+    
     def transition(self, actions):
-        return PlayerState(
+        return self._replace(
             hit_state=self.hit_state.transition(actions),
             card_state=self.card_state.transition(actions),
         )
@@ -242,13 +266,21 @@ class State(namedtuple(
     '''
     Contains two PlayerStates to represent the state of an entire game.
     '''
+    config = default_config
+    
     def transition(self, actions):
         a1, a2 = actions
-        return State(
+        return self._replace(
             p1=self.p1.transition(actions),
             p2=self.p2.transition((a2,a1)),
         )
     
+    def mirror(self):
+        '''
+        Swaps the roles of p1 and p2.
+        '''
+        return self._replace(p1=self.p2, p2=self.p1)
+    
     @property
     def terminal(self):
         return self.p1.terminal or self.p2.terminal
@@ -256,16 +288,17 @@ class State(namedtuple(
     @property
     def value(self):
         if self.terminal:
+            win, loss, draw = self.config.payoffs
             p1_dead = self.p1.is_dead
             p2_dead = self.p2.is_dead
             if p1_dead and p2_dead:
-                return 0.5
+                return draw
             elif p1_dead:
-                return 0.1
+                return loss
             elif p2_dead:
-                return 0.9
+                return win
             else:
-                return 0.5
+                return draw
         else:
             return None
     
@@ -308,17 +341,64 @@ class State(namedtuple(
             self.p2.card_state
         )
     
-    @staticmethod
-    def deserialize(data):
+    @classmethod
+    def deserialize(cls, data):
+        types = game_types(cls.config)
         data = tuple(int(d) for d in data.split(','))
-        p1_hit_state = HitState(data[:3])
-        p1_card_state = CardState(data[3:9])
-        p1 = PlayerState(p1_hit_state, p1_card_state)
-        p2_hit_state = HitState(data[9:12])
-        p2_card_state = CardState(data[12:])
-        p2 = PlayerState(p2_hit_state, p2_card_state)
-        return State(p1, p2)
+        p1_hit_state = types.HitState(*data[:3])
+        p1_card_state = types.CardState(*data[3:9])
+        p1 = types.PlayerState(p1_hit_state, p1_card_state)
+        p2_hit_state = types.HitState(*data[9:12])
+        p2_card_state = types.CardState(*data[12:])
+        p2 = types.PlayerState(p2_hit_state, p2_card_state)
+        return cls(p1, p2)
     
     @property
     def flat(self):
         return self.p1.flat + self.p2.flat
+
+# The classes above follow the rules of default_config.  Other configurations
+# get subclasses that override the config and the default starting state, so
+# State() is always the initial state of the game that it belongs to.
+GameTypes = namedtuple(
+    'GameTypes', ('HitState', 'CardState', 'PlayerState', 'State'))
+
+game_types_cache = {}
+
+def game_types(config=None):
+    '''
+    Returns the HitState, CardState, PlayerState and State classes for a
+    GameConfig.
+    '''
+    if config is None or config == default_config:
+        return GameTypes(HitState, CardState, PlayerState, State)
+    if config not in game_types_cache:
+        hit_state = config_type(HitState, config, (0, 0, 0))
+        card_state = config_type(CardState, config, config.start_cards)
+        player_state = config_type(
+            PlayerState, config, (hit_state(), card_state()))
+        state = config_type(State, config, (player_state(), player_state()))
+        game_types_cache[config] = GameTypes(
+            hit_state, card_state, player_state, state)
+    return game_types_cache[config]
+
+def config_type(base, config, defaults):
+    def __new__(cls, *args, **kwargs):
+        values = dict(zip(base._fields, defaults))
+        values.update(zip(base._fields, args))
+        values.update(kwargs)
+        return base.__new__(cls, **values)
+    
+    def __reduce__(self):
+        return rebuild_state, (self.config, base.__name__, tuple(self))
+    
+    return type(base.__name__, (base,), {
+        '__slots__' : (),
+        '__new__' : __new__,
+        '__reduce__' : __reduce__,
+        '_field_defaults' : dict(zip(base._fields, defaults)),
+        'config' : config,
+    })
+
+def rebuild_state(config, name, values):
+    return getattr(game_types(config), name)._make(values)
@@ -0,0 +1,138 @@
+import time
+import json
+import argparse
+
+import numpy
+
+from black_belt.bodega_brawl import game_configs, default_config
+from black_belt.game_statistics import load_successor_table
+from black_belt.solution_file import load_solution
+
+'''
+Checks how close a stored solution is to an equilibrium by computing the
+exact value of a best response against it in every state (see
+GameTables.best_response_values).  This is useful for confirming that
+quantized, approximate or symmetric solutions still hold up.
+
+A best response playing p1 against the solution gets best[s] in state s, and
+the solution playing p1 against a best response gets worst[s].  For an exact
+equilibrium both are the value of the game.  The exploitability of a state is
+(best[s] - worst[s]) / 2, which is how much a best response gains over the
+value of the game, averaged over the two seats, and does not require knowing
+that value.  The report shows the exploitability of the initial state, the
+largest difference between the stored values and the best response values,
+and the states with the largest exploitability.
+'''
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    'path', type=str, nargs='?', default=None,
+    help='The solution to check.  Defaults to solutions/<mode>_final.b4s.')
+parser.add_argument(
+    '--mode', type=str, default=None, choices=tuple(game_configs),
+    help='The game configuration of the solution.  Read from the solution '
+    'file if not given.')
+parser.add_argument(
+    '--worst', type=int, default=10,
+    help='The number of most exploitable states to report.')
+parser.add_argument(
+    '--successor-table', action='store_true',
+    help='Use the precomputed successor table.')
+parser.add_argument(
+    '--output', type=str, default=None,
+    help='Write the report to this json file.')
+
+def exploitability(
+    path=None,
+    config=None,
+    worst=10,
+    successor_table=False,
+    chunk_size=2**16,
+):
+    if path is None:
+        if config is None:
+            config = default_config
+        path = './solutions/%s_final.b4s'%config.name
+    solution = load_solution(path, config=config)
+    tables = solution.tables
+    config = solution.config
+
+    successors = None
+    if successor_table:
+        successors = load_successor_table(
+            './solutions/%s_successors.npy'%config.name)
+
+    start_time = time.time()
+    best, lowest, _ = tables.best_response_values(
+        solution.policy, successors=successors, chunk_size=chunk_size)
+    gap = (best - lowest) / 2.
+
+    # compare the stored values with the best response values
+    max_value_error = 0.
+    for start in range(0, tables.total_states, chunk_size):
+        end = min(start + chunk_size, tables.total_states)
+        value = solution.value(numpy.arange(start, end))
+        max_value_error = max(max_value_error, float(numpy.max(numpy.maximum(
+            best[start:end] - value, value - lowest[start:end]))))
+
+    root = tables.state_to_index(config.initial_state())
+    worst_indices = numpy.argsort(-gap, kind='stable')[:worst]
+    report = {
+        'path' : path,
+        'game_mode' : config.name,
+        'seconds' : time.time() - start_time,
+        'root_value' : float(solution.value(root)),
+        'root_best_response_value' : float(best[root]),
+        'root_worst_case_value' : float(lowest[root]),
+        'root_exploitability' : float(gap[root]),
+        'max_exploitability' : float(gap.max()),
+        'max_value_error' : max_value_error,
+        'worst_states' : [
+            {
+                'index' : int(index),
+                'state' : tables.index_to_state(int(index)).serialize(),
+                'value' : float(solution.value(index)),
+                'best_response_value' : float(best[index]),
+                'worst_case_value' : float(lowest[index]),
+                'exploitability' : float(gap[index]),
+            }
+            for index in worst_indices
+        ],
+    }
+
+    print('Checked %s in %.02fs'%(path, report['seconds']))
+    print('Initial state: Value: %.09f, Best Response: %.09f, '
+        'Worst Case: %.09f'%(
+        report['root_value'],
+        report['root_best_response_value'],
+        report['root_worst_case_value'],
+    ))
+    print('Exploitability: %.03e'%report['root_exploitability'])
+    print('Max Exploitability: %.03e'%report['max_exploitability'])
+    print('Max Value Error: %.03e'%report['max_value_error'])
+    for s in report['worst_states']:
+        print('%s: Value: %.06f, Best Response: %.06f, Worst Case: %.06f, '
+            'Exploitability: %.03e'%(
+            s['state'],
+            s['value'],
+            s['best_response_value'],
+            s['worst_case_value'],
+            s['exploitability'],
+        ))
+    return report
+
+def exploitability_commandline():
+    args = parser.parse_args()
+    config = None if args.mode is None else game_configs[args.mode]
+    report = exploitability(
+        path=args.path,
+        config=config,
+        worst=args.worst,
+        successor_table=args.successor_table,
+    )
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    exploitability_commandline()
@@ -1,130 +1,649 @@
-import time
-
 import numpy
 
-from black_belt.bodega_brawl import (
-    HitState,
-    CardState,
-    PlayerState,
-    State,
-    game_mode,
-    max_head_hits,
-    max_body_hits,
-    max_legs_hits,
-    max_total_hits,
-    start_head_a,
-    start_head_ac,
-    start_body_a,
-    start_body_ac,
-    start_legs_a,
-    start_legs_ac,
-)
+from black_belt import packed_state
+from black_belt.bodega_brawl import action_order, default_config, game_types
 
 '''
 This module compiles a list of all possible live hit states and card states
-so that the solver can iterate through them.
+so that the solver can iterate through them.  The tables depend on the rules
+of the game, so they are built by a GameTables object for a particular
+GameConfig.  Use game_tables to get them, which caches the tables of each
+configuration so they are only built once per process.  Nothing is built at
+import time, and building the tables only takes a few milliseconds even for
+the large game, because the loops only run over the hit states and the card
+states of a single player.  Solver workers are forked after the tables are
+built, so they inherit them.  The tables are therefore not cached on disk.
 '''
 
-# compute all live HitStates
-all_live_hit_states = []
-for h in range(max_head_hits):
-    for b in range(max_body_hits):
-        for l in range(max_legs_hits):
-            hit_state = HitState(h,b,l)
-            if not hit_state.is_dead:
-                all_live_hit_states.append(hit_state)
-
-# compute all possible CardStates
-# these are stored in a dictionary mapping the number of cards remaining to
-# all possible CardStates with that many cards
-card_states = {}
-for ha in range(start_head_a+1):
-    for hac in range(start_head_ac+1):
-        for ba in range(start_body_a+1):
-            for bac in range(start_body_ac+1):
-                for la in range(start_legs_a+1):
-                    for lac in range(start_legs_ac+1):
-                        card_state = CardState(ha, hac, ba, bac, la, lac)
-                        if card_state.total not in card_states:
-                            card_states[card_state.total] = []
-                        card_states[card_state.total].append(card_state)
-
-# compute the number of cards that a player starts with
-total_starting_cards = max(card_states.keys())
-
-# Make a lookup that maps a State to an integer index so that a policy can be
-# represented as one giant numpy array.  The first step is to make a set of
-# ranges that describe where the CardStates with different numbers of cards
-# will reside in the final index space.
-total_states = 0
-card_count_ranges = {}
-for i in range(1, total_starting_cards+1):
-    start = total_states
-    total_states += len(card_states[i])**2*len(all_live_hit_states)**2
-    card_count_ranges[i] = start, total_states
-
-# maps a State to an integer index
-def state_to_index(state):
-    p1_cards = state.p1.card_state.total
-    p2_cards = state.p2.card_state.total
-    assert p1_cards == p2_cards
-    range_start, range_end = card_count_ranges[p1_cards]
-
-    p1_c = card_states[p1_cards].index(state.p1.card_state)
-    p2_c = card_states[p1_cards].index(state.p2.card_state)
-    p1_h = all_live_hit_states.index(state.p1.hit_state)
-    p2_h = all_live_hit_states.index(state.p2.hit_state)
-
-    c = len(card_states[p1_cards])
-    h = len(all_live_hit_states)
-
-    index = numpy.ravel_multi_index((p1_c, p2_c, p1_h, p2_h), (c, c, h, h))
-    index += range_start
-    assert index < range_end
-    return index
-
-# maps an integer index to a State
-def index_to_state(index):
+# Successor table entries for action pairs that do not lead to a live state.
+# Terminal successors are stored as -(1 + 2*p1_dead + p2_dead), and illegal
+# action pairs as illegal_successor.  GameTables.successor_values[entry] then
+# gives the value of any of these entries using numpy's negative indexing.
+illegal_successor = -5
+
+# terminal_outcomes[entry] is the one-hot (p1 win, draw, p1 loss) outcome of a
+# negative successor table entry, and all zeros for illegal action pairs
+terminal_outcomes = numpy.zeros((6, 3))
+terminal_outcomes[-1] = 0., 1., 0.
+terminal_outcomes[-2] = 1., 0., 0.
+terminal_outcomes[-3] = 0., 0., 1.
+terminal_outcomes[-4] = 0., 1., 0.
+
+game_tables_cache = {}
+
+def game_tables(config=None):
+    '''
+    Returns the GameTables for a GameConfig, building them the first time
+    they are requested.
+    '''
+    if config is None:
+        config = default_config
+    if config not in game_tables_cache:
+        game_tables_cache[config] = GameTables(config)
+    return game_tables_cache[config]
+
+def load_successor_table(path):
+    return numpy.load(path, mmap_mode='r')
+
+class GameTables:
+    def __init__(self, config=None):
+        if config is None:
+            config = default_config
+        self.config = config
+        self.types = game_types(config)
+        HitState = self.types.HitState
+        CardState = self.types.CardState
+        start_cards = CardState()
+
+        # compute all live HitStates
+        self.all_live_hit_states = []
+        for h in range(config.max_head_hits):
+            for b in range(config.max_body_hits):
+                for l in range(config.max_legs_hits):
+                    hit_state = HitState(h,b,l)
+                    if not hit_state.is_dead:
+                        self.all_live_hit_states.append(hit_state)
+
+        # compute all possible CardStates
+        # these are stored in a dictionary mapping the number of cards
+        # remaining to all possible CardStates with that many cards
+        card_states = {}
+        for counts in numpy.ndindex(*(n+1 for n in start_cards)):
+            card_state = CardState(*(int(c) for c in counts))
+            if card_state.total not in card_states:
+                card_states[card_state.total] = []
+            card_states[card_state.total].append(card_state)
+        self.card_states = card_states
+
+        # compute the number of cards that a player starts with
+        self.total_starting_cards = max(card_states.keys())
+
+        # Make a lookup that maps a State to an integer index so that a
+        # policy can be represented as one giant numpy array.  The first step
+        # is to make a set of ranges that describe where the CardStates with
+        # different numbers of cards will reside in the final index space.
+        total_states = 0
+        self.card_count_ranges = {}
+        h = len(self.all_live_hit_states)
+        for i in range(1, self.total_starting_cards+1):
+            start = total_states
+            total_states += len(card_states[i])**2*h**2
+            self.card_count_ranges[i] = start, total_states
+        self.total_states = total_states
+
+        # inverse lookups that map a HitState or CardState back to its
+        # position in all_live_hit_states or card_states[num_cards]
+        self.hit_state_positions = {
+            hit_state : i
+            for i, hit_state in enumerate(self.all_live_hit_states)
+        }
+        self.card_state_positions = {}
+        for num_cards, num_card_states in card_states.items():
+            for i, card_state in enumerate(num_card_states):
+                self.card_state_positions[card_state] = i
+
+        # Array versions of the tables above for the batch conversions below.
+        # Hit states and card states are encoded as mixed-radix integers so
+        # that the position lookup is a single gather.
+        self.hit_state_shape = (
+            config.max_head_hits, config.max_body_hits, config.max_legs_hits)
+        self.hit_state_table = numpy.array(
+            self.all_live_hit_states, dtype=numpy.int64)
+        self.hit_state_position_table = numpy.full(
+            numpy.prod(self.hit_state_shape), -1, dtype=numpy.int64)
+        self.hit_state_position_table[numpy.ravel_multi_index(
+            self.hit_state_table.T, self.hit_state_shape)] = numpy.arange(h)
+
+        self.card_state_shape = tuple(n+1 for n in start_cards)
+        self.card_state_table = numpy.array(
+            [card_state
+             for num_cards in range(self.total_starting_cards+1)
+             for card_state in card_states[num_cards]],
+            dtype=numpy.int64,
+        )
+        self.card_state_counts = numpy.array(
+            [len(card_states[i]) for i in range(self.total_starting_cards+1)],
+            dtype=numpy.int64,
+        )
+        self.card_state_offsets = numpy.concatenate(
+            ([0], numpy.cumsum(self.card_state_counts)))
+        self.card_state_position_table = numpy.full(
+            numpy.prod(self.card_state_shape), -1, dtype=numpy.int64)
+        self.card_state_position_table[numpy.ravel_multi_index(
+            self.card_state_table.T, self.card_state_shape)] = (
+                numpy.arange(len(self.card_state_table)) -
+                numpy.repeat(
+                    self.card_state_offsets[:-1], self.card_state_counts)
+            )
+
+        # Packed versions of the tables above for converting directly between
+        # packed states (see packed_state.py) and indices.  The packed hit
+        # counters of a player index hit_code_positions, and the packed card
+        # counters (shifted down by hit_bits) index card_code_positions and
+        # card_code_totals.
+        bits = packed_state.bits_per_counter
+        self.hit_state_codes = numpy.bitwise_or.reduce(
+            self.hit_state_table << (numpy.arange(3) * bits), axis=1)
+        self.card_state_codes = numpy.bitwise_or.reduce(
+            self.card_state_table << (numpy.arange(6) * bits), axis=1)
+        self.hit_code_positions = numpy.full(
+            1 << packed_state.hit_bits, -1, dtype=numpy.int64)
+        self.hit_code_positions[self.hit_state_codes] = numpy.arange(h)
+        card_code_size = 1 << (packed_state.player_bits - packed_state.hit_bits)
+        self.card_code_positions = numpy.full(
+            card_code_size, -1, dtype=numpy.int64)
+        self.card_code_positions[self.card_state_codes] = (
+            self.card_state_position_table[numpy.ravel_multi_index(
+                self.card_state_table.T, self.card_state_shape)])
+        self.card_code_totals = numpy.zeros(card_code_size, dtype=numpy.int64)
+        self.card_code_totals[self.card_state_codes] = (
+            self.card_state_table.sum(axis=1))
+
+        # card_state_action_masks[i] marks the actions available to a player
+        # holding the cards in card_state_table[i]
+        self.action_card_columns = numpy.array(
+            [CardState._fields.index(a.card_name()) for a in action_order])
+        self.card_state_action_masks = (
+            self.card_state_table[:,self.action_card_columns] > 0)
+
+        # card_count_starts[n] is the first index of the states where each
+        # player has n cards, with an extra entry at the end for total_states
+        self.card_count_starts = numpy.array(
+            [0] +
+            [self.card_count_ranges[i][0]
+             for i in range(1, self.total_starting_cards+1)] +
+            [total_states],
+            dtype=numpy.int64,
+        )
+
+        # The game is symmetric: the value of State(p2, p1) is one minus the
+        # value of State(p1, p2) and the players' policies trade places.  This
+        # means we only need to solve one state out of each mirrored pair.
+        # Within a layer, give each player a combined position
+        # u = card_position * h + hit_position.  A state is canonical when
+        # u1 <= u2, and the canonical states of a layer are numbered in
+        # row-major order over the upper triangle of the (u1, u2) grid.  The
+        # diagonal (u1 == u2) states are their own mirror and have a value of
+        # exactly 0.5.  This only holds when config.symmetric is True.
+        self.canonical_sizes = (
+            self.card_state_counts * h * (self.card_state_counts * h + 1) // 2)
+        self.canonical_count_starts = numpy.concatenate(
+            ([0, 0], numpy.cumsum(self.canonical_sizes[1:])))
+        self.total_canonical_states = int(self.canonical_count_starts[-1])
+
+        # successor_values[entry] gives the value of a negative successor
+        # table entry
+        self.successor_values = numpy.concatenate(
+            ([numpy.nan], packed_state.value_table(config)[::-1]))
+
+    # maps a State to an integer index
+    def state_to_index(self, state):
+        p1_cards = state.p1.card_state.total
+        p2_cards = state.p2.card_state.total
+        assert p1_cards == p2_cards
+        range_start, range_end = self.card_count_ranges[p1_cards]
+
+        p1_c = self.card_state_positions[state.p1.card_state]
+        p2_c = self.card_state_positions[state.p2.card_state]
+        p1_h = self.hit_state_positions[state.p1.hit_state]
+        p2_h = self.hit_state_positions[state.p2.hit_state]
+
+        c = self.card_state_counts[p1_cards]
+        h = len(self.all_live_hit_states)
+
+        index = range_start + ((p1_c * c + p2_c) * h + p1_h) * h + p2_h
+        assert index < range_end
+        return int(index)
+
+    # maps an integer index to a State
+    def index_to_state(self, index):
+        '''
+        Maps an integer index to a game state.  States with more cards are
+        indexed with smaller values than those with more cards.
+        '''
+        if index < 0 or index >= self.total_states:
+            raise IndexError('index too large')
+        num_cards = int(numpy.searchsorted(
+            self.card_count_starts, index, side='right')) - 1
+        range_start = self.card_count_starts[num_cards]
+
+        c = self.card_state_counts[num_cards]
+        h = len(self.all_live_hit_states)
+        p1_c, p2_c, p1_h, p2_h = numpy.unravel_index(
+            index - range_start, (c, c, h, h))
+
+        p1 = self.types.PlayerState(
+            self.all_live_hit_states[p1_h],
+            self.card_states[num_cards][p1_c],
+        )
+        p2 = self.types.PlayerState(
+            self.all_live_hit_states[p2_h],
+            self.card_states[num_cards][p2_c],
+        )
+        return self.types.State(p1, p2)
+
+    # maps an (N,18) array of flat states to an array of N integer indices
+    def states_to_indices(self, states):
+        '''
+        Batch version of state_to_index.  Each row of states should be laid
+        out the same way as State.flat: p1 hit state, p1 card state, p2 hit
+        state, p2 card state.  All states must be non-terminal.
+        '''
+        states = numpy.asarray(states, dtype=numpy.int64).reshape(-1, 18)
+        p1_h = self.hit_state_position_table[
+            numpy.ravel_multi_index(states[:,0:3].T, self.hit_state_shape)]
+        p1_c = self.card_state_position_table[
+            numpy.ravel_multi_index(states[:,3:9].T, self.card_state_shape)]
+        p2_h = self.hit_state_position_table[
+            numpy.ravel_multi_index(states[:,9:12].T, self.hit_state_shape)]
+        p2_c = self.card_state_position_table[
+            numpy.ravel_multi_index(states[:,12:18].T, self.card_state_shape)]
+        num_cards = states[:,3:9].sum(axis=1)
+        assert numpy.all(num_cards == states[:,12:18].sum(axis=1))
+        assert numpy.all(num_cards > 0)
+        assert numpy.all(p1_h >= 0) and numpy.all(p2_h >= 0)
+
+        c = self.card_state_counts[num_cards]
+        h = len(self.all_live_hit_states)
+
+        return self.card_count_starts[num_cards] + (
+            (p1_c * c + p2_c) * h + p1_h) * h + p2_h
+
+    # maps an array of N integer indices to an (N,18) array of flat states
+    def unravel_indices(self, indices):
+        '''
+        Splits an array of state indices into the number of cards in each
+        hand and the positions of p1's card state, p2's card state, p1's hit
+        state and p2's hit state within card_states[num_cards] and
+        all_live_hit_states.
+        '''
+        indices = numpy.asarray(indices, dtype=numpy.int64).reshape(-1)
+        if numpy.any(indices < 0) or numpy.any(indices >= self.total_states):
+            raise IndexError('index too large')
+        num_cards = numpy.searchsorted(
+            self.card_count_starts, indices, side='right') - 1
+
+        c = self.card_state_counts[num_cards]
+        h = len(self.all_live_hit_states)
+        local = indices - self.card_count_starts[num_cards]
+        p2_h = local % h
+        local //= h
+        p1_h = local % h
+        local //= h
+        p2_c = local % c
+        p1_c = local // c
+        return num_cards, p1_c, p2_c, p1_h, p2_h
+
+    def ravel_indices(self, num_cards, p1_c, p2_c, p1_h, p2_h):
+        '''
+        The inverse of unravel_indices.
+        '''
+        c = self.card_state_counts[num_cards]
+        h = len(self.all_live_hit_states)
+        return self.card_count_starts[num_cards] + (
+            (p1_c * c + p2_c) * h + p1_h) * h + p2_h
+
+    def indices_to_states(self, indices):
+        '''
+        Batch version of index_to_state.  Returns an (N,18) uint8 array with
+        rows laid out the same way as State.flat.
+        '''
+        num_cards, p1_c, p2_c, p1_h, p2_h = self.unravel_indices(indices)
+
+        offsets = self.card_state_offsets[num_cards]
+        states = numpy.empty((num_cards.shape[0], 18), dtype=numpy.uint8)
+        states[:,0:3] = self.hit_state_table[p1_h]
+        states[:,3:9] = self.card_state_table[offsets + p1_c]
+        states[:,9:12] = self.hit_state_table[p2_h]
+        states[:,12:18] = self.card_state_table[offsets + p2_c]
+        return states
+
+    def codes_to_indices(self, codes):
+        '''
+        Maps an array of packed states to their indices.  This is the same as
+        states_to_indices(packed_state.unpack_rows(codes)) but skips the
+        unpacking, and does not check that the states are live.
+        '''
+        codes = numpy.asarray(codes, dtype=numpy.int64)
+        hit_bits = packed_state.hit_bits
+        p1 = codes & packed_state.player_mask
+        p2 = codes >> packed_state.player_bits
+        return self.ravel_indices(
+            self.card_code_totals[p1 >> hit_bits],
+            self.card_code_positions[p1 >> hit_bits],
+            self.card_code_positions[p2 >> hit_bits],
+            self.hit_code_positions[p1 & packed_state.hit_mask],
+            self.hit_code_positions[p2 & packed_state.hit_mask],
+        )
+
+    def indices_to_codes(self, indices):
+        '''
+        Maps an array of state indices to packed states.
+        '''
+        num_cards, p1_c, p2_c, p1_h, p2_h = self.unravel_indices(indices)
+        offsets = self.card_state_offsets[num_cards]
+        hit_bits = packed_state.hit_bits
+        p1 = (self.hit_state_codes[p1_h] |
+            (self.card_state_codes[offsets + p1_c] << hit_bits))
+        p2 = (self.hit_state_codes[p2_h] |
+            (self.card_state_codes[offsets + p2_c] << hit_bits))
+        return p1 | (p2 << packed_state.player_bits)
+
+    def action_masks(self, indices):
+        '''
+        Returns two (N,9) boolean arrays marking the actions available to p1
+        and p2 in each of an array of N states.
+        '''
+        num_cards, p1_c, p2_c, p1_h, p2_h = self.unravel_indices(indices)
+        offsets = self.card_state_offsets[num_cards]
+        return (
+            self.card_state_action_masks[offsets + p1_c],
+            self.card_state_action_masks[offsets + p2_c],
+        )
+
+    def mirror_indices(self, indices):
+        '''
+        Maps an array of state indices to the indices of their mirror states.
+        '''
+        num_cards, p1_c, p2_c, p1_h, p2_h = self.unravel_indices(indices)
+        return self.ravel_indices(num_cards, p2_c, p1_c, p2_h, p1_h)
+
+    def canonical_indices(self, indices):
+        '''
+        Maps an array of state indices to an array of canonical indices and a
+        boolean array that is True where the state is the mirror of its
+        canonical state rather than the canonical state itself.
+        '''
+        num_cards, p1_c, p2_c, p1_h, p2_h = self.unravel_indices(indices)
+        h = len(self.all_live_hit_states)
+        k = self.card_state_counts[num_cards] * h
+        u1 = p1_c * h + p1_h
+        u2 = p2_c * h + p2_h
+        mirrored = u1 > u2
+        a = numpy.minimum(u1, u2)
+        b = numpy.maximum(u1, u2)
+        canonical = (
+            self.canonical_count_starts[num_cards] +
+            a*k - a*(a-1)//2 + (b - a)
+        )
+        return canonical, mirrored
+
+    def canonical_to_indices(self, canonical):
+        '''
+        Maps an array of canonical indices to the indices of the canonical
+        states.
+        '''
+        canonical = numpy.asarray(canonical, dtype=numpy.int64).reshape(-1)
+        if numpy.any(canonical < 0) or numpy.any(
+            canonical >= self.total_canonical_states):
+            raise IndexError('index too large')
+        num_cards = numpy.searchsorted(
+            self.canonical_count_starts, canonical, side='right') - 1
+        h = len(self.all_live_hit_states)
+        k = self.card_state_counts[num_cards] * h
+        t = canonical - self.canonical_count_starts[num_cards]
+
+        # invert t = a*k - a*(a-1)/2 + (b-a), then correct any rounding error
+        a = numpy.floor(
+            ((2*k+1) - numpy.sqrt((2*k+1)**2 - 8*t)) / 2).astype(numpy.int64)
+        a -= (a*k - a*(a-1)//2) > t
+        a += ((a+1)*k - (a+1)*a//2) <= t
+        b = t - (a*k - a*(a-1)//2) + a
+        return self.ravel_indices(num_cards, a // h, b // h, a % h, b % h)
+
+    def successor_entries(self, codes, p1_actions, p2_actions):
+        '''
+        Returns the successor table entries for an array of packed states
+        when p1 plays p1_actions and p2 plays p2_actions, which must be
+        legal.  Entries are either the index of the successor or one of the
+        negative terminal entries described at the top of this module.
+        '''
+        config = self.config
+        successor_codes = packed_state.transition(
+            codes, p1_actions, p2_actions)
+        terminal = packed_state.terminal(successor_codes, config)
+        p1_dead = packed_state.p1_dead(successor_codes, config)
+        p2_dead = packed_state.p2_dead(successor_codes, config)
+        entries = -(1 + 2*p1_dead.astype(numpy.int64) + p2_dead)
+        entries[~terminal] = self.codes_to_indices(successor_codes[~terminal])
+        return entries
+
+    def successor_indices(self, indices):
+        '''
+        Computes the successors of an array of N state indices.  Returns an
+        (N,9,9) int64 array where entry [n,j,i] holds the index of the state
+        reached when p1 plays action i and p2 plays action j from indices[n],
+        or one of the negative entries described at the top of this module.
+        The [j,i] layout matches the orientation of payoff_matrix.
+        '''
+        indices = numpy.asarray(indices, dtype=numpy.int64).reshape(-1)
+        p1_mask, p2_mask = self.action_masks(indices)
+        legal = p2_mask[:,:,None] & p1_mask[:,None,:]
+        successors = numpy.full(legal.shape, illegal_successor)
+        n, j, i = numpy.nonzero(legal)
+        successors[n, j, i] = self.successor_entries(
+            self.indices_to_codes(indices)[n], i, j)
+        return successors
+
+    def build_successor_table(self, path, chunk_size=2**16):
+        '''
+        Computes successor_indices for every state and writes the resulting
+        (total_states,9,9) int32 table to a .npy file at path.  The table can
+        be opened later with load_successor_table without reading it into
+        memory.
+        '''
+        import tqdm
+        
+        table = numpy.lib.format.open_memmap(
+            path,
+            mode='w+',
+            dtype=numpy.int32,
+            shape=(self.total_states, 9, 9),
+        )
+        for start in tqdm.tqdm(range(0, self.total_states, chunk_size)):
+            end = min(start + chunk_size, self.total_states)
+            table[start:end] = self.successor_indices(numpy.arange(start, end))
+        table.flush()
+        return table
+
+    # generates payoff matrices for an array of N state indices using a
+    # successor table and the known values of all successor states
+    def payoff_matrices(self, indices, value, successors=None):
+        '''
+        Returns an (N,9,9) payoff array in the same [p2 action, p1 action]
+        orientation as payoff_matrix.  Entries for illegal action pairs are
+        nan.  If no successor table is provided, the successors are computed
+        on the fly.
+        '''
+        if successors is None:
+            entries = self.successor_indices(indices)
+        else:
+            entries = numpy.asarray(successors[indices], dtype=numpy.int64)
+        payoff = self.successor_values[numpy.minimum(entries, -1)]
+        live = entries >= 0
+        payoff[live] = value[entries[live]]
+        return payoff
+
+    def outcome_probabilities(
+        self,
+        policy,
+        opponent_policy,
+        successors=None,
+        chunk_size=2**16,
+    ):
+        '''
+        Computes the exact probability of each outcome of the game from every
+        state when p1 plays policy and p2 plays opponent_policy.  Both are
+        functions that map an array of N state indices to an (N,9) array of
+        policies, and are called with states from the point of view of the
+        player they belong to, so opponent_policy gets the mirrored states.
+        The policies must be stationary: they may only depend on the state.
+        
+        Successors always have fewer cards, so this is a single backward pass
+        over the card-count layers.  Returns a (total_states,3) array of the
+        probabilities of a p1 win, a draw and a p1 loss.
+        '''
+        outcomes = numpy.zeros((self.total_states, 3))
+        for num_cards in range(1, self.total_starting_cards+1):
+            layer_start = self.card_count_starts[num_cards]
+            layer_end = self.card_count_starts[num_cards+1]
+            for start in range(layer_start, layer_end, chunk_size):
+                indices = numpy.arange(start, min(start+chunk_size, layer_end))
+                p1 = policy(indices)
+                p2 = opponent_policy(self.mirror_indices(indices))
+                
+                # only visit the action pairs that can actually be played
+                weights = p2[:,:,None] * p1[:,None,:]
+                n, j, i = numpy.nonzero(weights)
+                weights = weights[n, j, i]
+                if successors is None:
+                    entries = self.successor_entries(
+                        self.indices_to_codes(indices)[n], i, j)
+                else:
+                    entries = numpy.asarray(
+                        successors[indices[n], j, i], dtype=numpy.int64)
+                successor_outcomes = terminal_outcomes[
+                    numpy.minimum(entries, -1)]
+                live = entries >= 0
+                successor_outcomes[live] = outcomes[entries[live]]
+                for k in range(3):
+                    outcomes[indices, k] = numpy.bincount(
+                        n,
+                        weights=weights * successor_outcomes[:,k],
+                        minlength=len(indices),
+                    )
+        return outcomes
+
+    def best_response_values(self, policy, successors=None, chunk_size=2**16):
+        '''
+        Computes the exact values of playing against a best response to a
+        stationary policy.  policy maps an array of N state indices to an
+        (N,9) array of policies, and both players use it from their own point
+        of view.  Like outcome_probabilities, this is a single backward pass
+        over the card-count layers, and each state picks its best response
+        with the same first-best rule as ne.best_response.
+
+        Returns three total_states arrays:
+        best : the value of p1 playing a best response against p2 playing
+            policy
+        worst : the value of p1 playing policy against a p2 best response
+        best_actions : the action p1 plays in best
+        If policy is an equilibrium, best and worst are both the value of the
+        game, and best - worst measures how far from one it is in each state.
+        '''
+        best = numpy.zeros(self.total_states)
+        worst = numpy.zeros(self.total_states)
+        best_actions = numpy.zeros(self.total_states, dtype=numpy.int8)
+        for num_cards in range(1, self.total_starting_cards+1):
+            layer_start = self.card_count_starts[num_cards]
+            layer_end = self.card_count_starts[num_cards+1]
+            for start in range(layer_start, layer_end, chunk_size):
+                indices = numpy.arange(start, min(start+chunk_size, layer_end))
+                p1 = policy(indices)
+                p2 = policy(self.mirror_indices(indices))
+                p1_masks, p2_masks = self.action_masks(indices)
+
+                # the successors of every legal action pair
+                legal = p2_masks[:,:,None] & p1_masks[:,None,:]
+                n, j, i = numpy.nonzero(legal)
+                if successors is None:
+                    entries = self.successor_entries(
+                        self.indices_to_codes(indices)[n], i, j)
+                else:
+                    entries = numpy.asarray(
+                        successors[indices[n], j, i], dtype=numpy.int64)
+                live = entries >= 0
+                terminal_values = self.successor_values[
+                    numpy.minimum(entries, -1)]
+
+                # p1 maximizes its expected payoff against p2's policy
+                payoff = terminal_values.copy()
+                payoff[live] = best[entries[live]]
+                expected = numpy.bincount(
+                    n*9 + i,
+                    weights=p2[n,j] * payoff,
+                    minlength=len(indices)*9,
+                ).reshape(-1, 9)
+                expected[~p1_masks] = -numpy.inf
+                maximum = expected.max(axis=1, keepdims=True)
+                actions = (expected >= maximum - 1e-12).argmax(axis=1)
+                best[indices] = maximum[:,0]
+                best_actions[indices] = actions
+
+                # p2 minimizes p1's expected payoff against p1's policy
+                payoff = terminal_values
+                payoff[live] = worst[entries[live]]
+                expected = numpy.bincount(
+                    n*9 + j,
+                    weights=p1[n,i] * payoff,
+                    minlength=len(indices)*9,
+                ).reshape(-1, 9)
+                expected[~p2_masks] = numpy.inf
+                worst[indices] = expected.min(axis=1)
+        return best, worst, best_actions
+
+    # generates a payoff matrix for a particular state using known values of
+    # all possible successor states
+    def payoff_matrix(self, state, value, successors=None):
+        p1_actions, p2_actions = state.action_space
+        if successors is not None:
+            index = self.state_to_index(state)
+            payoff = self.payoff_matrices([index], value, successors)[0]
+            p2_indices = [int(a) for a in p2_actions]
+            p1_indices = [int(a) for a in p1_actions]
+            return payoff[numpy.ix_(p2_indices, p1_indices)], p1_actions
+
+        payoff = numpy.zeros((len(p2_actions), len(p1_actions)))
+        for i, p1_action in enumerate(p1_actions):
+            for j, p2_action in enumerate(p2_actions):
+                successor = state.transition((p1_action, p2_action))
+                successor_value = successor.value
+                if successor_value is None:
+                    successor_index = self.state_to_index(successor)
+                    successor_value = value[successor_index]
+                payoff[j,i] = successor_value
+
+        return payoff, p1_actions
+
+class MirroredValues:
     '''
-    Maps an integer index to a game state.  States with more cards are indexed
-    with smaller values than those with more cards.
+    Presents an array of values for the canonical states as if it were an
+    array of values for every state, so that it can be passed anywhere a
+    value array is expected.
     '''
-    for num_cards, (range_start, range_end) in card_count_ranges.items():
-        if index >= range_start and index < range_end:
-            break
-    else:
-        raise IndexError('index too large')
-
-    c = len(card_states[num_cards])
-    h = len(all_live_hit_states)
-    p1_c, p2_c, p1_h, p2_h = numpy.unravel_index(
-        index - range_start, (c, c, h, h))
-
-    p1 = PlayerState(
-        all_live_hit_states[p1_h],
-        card_states[num_cards][p1_c],
-    )
-    p2 = PlayerState(
-        all_live_hit_states[p2_h],
-        card_states[num_cards][p2_c],
-    )
-    return State(p1, p2)
-
-# generates a payoff matrix for a particular state using known values of all
-# possible successor states
-def payoff_matrix(state, value, complete=None):
-    p1_actions, p2_actions = state.action_space
-    payoff = numpy.zeros((len(p2_actions), len(p1_actions)))
-    for i, p1_action in enumerate(p1_actions):
-        for j, p2_action in enumerate(p2_actions):
-            successor = state.transition((p1_action, p2_action))
-            successor_value = successor.value
-            if successor_value is None:
-                successor_index = state_to_index(successor)
-                if complete is not None:
-                    while not complete[successor_index]:
-                        time.sleep(0.1)
-                successor_value = value[successor_index]
-            payoff[j,i] = successor_value
-
-    return payoff, p1_actions
+    def __init__(self, canonical_values, tables=None):
+        if tables is None:
+            tables = game_tables()
+        self.canonical_values = canonical_values
+        self.tables = tables
+
+    def __len__(self):
+        return self.tables.total_states
+
+    def __getitem__(self, indices):
+        canonical, mirrored = self.tables.canonical_indices(indices)
+        v = numpy.asarray(self.canonical_values[canonical], dtype=numpy.float64)
+        v = numpy.where(mirrored, 1. - v, v)
+        if numpy.ndim(indices):
+            return v.reshape(numpy.shape(indices))
+        return v[0]
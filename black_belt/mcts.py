@@ -0,0 +1,562 @@
+import math
+import time
+import array
+import random
+import multiprocessing
+
+import numpy
+
+from black_belt import packed_state
+from black_belt.bodega_brawl import game_configs
+from black_belt.game_statistics import game_tables
+from black_belt.solution_file import load_solution
+
+'''
+A Monte Carlo tree search over packed states (see packed_state.py).  Instead
+of an object per node, the statistics of every node are kept in flat arrays
+that are allocated up front and doubled when they fill up.  A transposition
+table maps the index of each state in the tree (see GameTables) to its node
+slot, so a state that can be reached along several paths shares one node.
+
+Each node runs decoupled UCB for both players.  Actions that have not been
+tried yet are tried first in a random order, and after that each player picks
+the action with the largest mean value plus c * log(visits) / child_visits.
+The search adds one node per sample and scores it with a random rollout.
+Rollouts can also be cut off after a few turns and the state they stop in
+scored by a leaf evaluator: the values of a solution (ValueEvaluator), the
+values of a smaller solved variant of the game (VariantEvaluator) or a
+heuristic based on how many more hits each player can take (HitsEvaluator).
+Since the evaluator's values are much less noisy than a full random
+rollout, far fewer samples are needed for the same strength.
+
+RootParallelSearch runs a separate tree in each of several worker processes
+and adds up the statistics of the root's actions.  This lets a search use
+every core within a fixed time per move.
+
+All of the per-sample work is done on plain python integers, lists and
+arrays from the array module, which are much faster than numpy for the
+handful of scalars touched at each step.  Using arrays rather than lists for
+the statistics also keeps them out of the garbage collector's way.
+'''
+
+player_mask = packed_state.player_mask
+player_bits = packed_state.player_bits
+hit_mask = packed_state.hit_mask
+hit_bits = packed_state.hit_bits
+
+# the edge entry of a pair of actions that has not been tried yet
+unexplored = -5
+
+class PackedIndex:
+    '''
+    Maps single packed states to their indices with plain python integers,
+    the same as GameTables.codes_to_indices.
+    '''
+    def __init__(self, tables):
+        self.hit_positions = tables.hit_code_positions.tolist()
+        self.card_positions = tables.card_code_positions.tolist()
+        self.card_totals = tables.card_code_totals.tolist()
+        self.layer_starts = tables.card_count_starts.tolist()
+        self.layer_sizes = tables.card_state_counts.tolist()
+        self.num_hit_states = len(tables.all_live_hit_states)
+
+    def __call__(self, code):
+        p1 = code & player_mask
+        p2 = code >> player_bits
+        n = self.card_totals[p1 >> hit_bits]
+        h = self.num_hit_states
+        return self.layer_starts[n] + (
+            (self.card_positions[p1 >> hit_bits] * self.layer_sizes[n] +
+            self.card_positions[p2 >> hit_bits]) * h +
+            self.hit_positions[p1 & hit_mask]) * h + (
+            self.hit_positions[p2 & hit_mask])
+
+def solution_values(solution, chunk_size=2**20):
+    '''
+    Reads the value of every state of a solution into a float32 array so
+    that single values can be looked up quickly.
+    '''
+    total_states = solution.tables.total_states
+    values = numpy.empty(total_states, dtype=numpy.float32)
+    for start in range(0, total_states, chunk_size):
+        end = min(start + chunk_size, total_states)
+        values[start:end] = solution.value(numpy.arange(start, end))
+    return values
+
+class ValueEvaluator:
+    '''
+    Scores live packed states of config with an array of values over the
+    state indices of config, such as the values of a solution.
+    '''
+    def __init__(self, values, config=None):
+        self.values = values
+        self.index = PackedIndex(game_tables(config))
+
+    def __call__(self, code):
+        return float(self.values[self.index(code)])
+
+class VariantEvaluator:
+    '''
+    Scores live packed states of config with the values of a different
+    variant of the game, usually a smaller one that has been solved.  Each
+    player's state is mapped to the closest state of the variant: every body
+    region and the total keep as many hits remaining as the variant allows,
+    and each card count is cut down to the variant's starting count.  The
+    two players always hold the same number of cards, so cards are then
+    removed from the most plentiful type, or added to the type with the
+    most room, until each player holds the smaller of that number and the
+    number the variant starts with.
+    '''
+    def __init__(self, values, variant_config, config=None):
+        tables = game_tables(config)
+        variant_tables = game_tables(variant_config)
+        config = tables.config
+        self.values = values
+        self.index = PackedIndex(variant_tables)
+
+        limits = numpy.array([
+            config.max_head_hits, config.max_body_hits, config.max_legs_hits])
+        variant_limits = numpy.array([
+            variant_config.max_head_hits,
+            variant_config.max_body_hits,
+            variant_config.max_legs_hits,
+        ])
+        bits = packed_state.bits_per_counter
+        def pack(counters):
+            return sum(int(c) << (bits * i) for i, c in enumerate(counters))
+
+        self.hit_codes = [0] * (1 << hit_bits)
+        for code, hits in zip(tables.hit_state_codes, tables.hit_state_table):
+            variant_hits = numpy.maximum(variant_limits - (limits - hits), 0)
+            total_remaining = config.max_total_hits - hits.sum()
+            max_total = variant_config.max_total_hits - min(
+                total_remaining, variant_config.max_total_hits)
+            while variant_hits.sum() > max_total:
+                variant_hits[variant_hits.argmax()] -= 1
+            self.hit_codes[code] = pack(variant_hits)
+
+        start_cards = numpy.array(variant_config.start_cards)
+        self.card_codes = {}
+        for code, cards in zip(
+            tables.card_state_codes, tables.card_state_table):
+            num_cards = min(cards.sum(), start_cards.sum())
+            variant_cards = numpy.minimum(cards, start_cards)
+            while variant_cards.sum() > num_cards:
+                variant_cards[variant_cards.argmax()] -= 1
+            while variant_cards.sum() < num_cards:
+                variant_cards[(start_cards - variant_cards).argmax()] += 1
+            self.card_codes[int(code)] = pack(variant_cards)
+
+    def __call__(self, code):
+        p1 = code & player_mask
+        p2 = code >> player_bits
+        p1 = self.hit_codes[p1 & hit_mask] | (
+            self.card_codes[p1 >> hit_bits] << hit_bits)
+        p2 = self.hit_codes[p2 & hit_mask] | (
+            self.card_codes[p2 >> hit_bits] << hit_bits)
+        return float(self.values[self.index(p1 | (p2 << player_bits))])
+
+class HitsEvaluator:
+    '''
+    A cheap estimate of the value of live packed states of config that only
+    looks at how many more hits each player can take before dying, d1 and
+    d2, the same quantity ArgmaxCounterAgent uses to pick a region to
+    attack.  p1's chance of winning is taken to be d1 / (d1 + d2).
+    '''
+    def __init__(self, config=None):
+        tables = game_tables(config)
+        config = tables.config
+        win, loss, draw = config.payoffs
+        self.win = win
+        self.loss = loss
+        limits = numpy.array([
+            config.max_head_hits, config.max_body_hits, config.max_legs_hits])
+        self.hits_remaining = [0] * (1 << hit_bits)
+        for code, hits in zip(tables.hit_state_codes, tables.hit_state_table):
+            self.hits_remaining[code] = int(min(
+                (limits - hits).min(), config.max_total_hits - hits.sum()))
+
+    def __call__(self, code):
+        p1 = self.hits_remaining[code & hit_mask]
+        p2 = self.hits_remaining[(code >> player_bits) & hit_mask]
+        return self.loss + (self.win - self.loss) * p1 / (p1 + p2)
+
+def make_evaluator(name, config=None):
+    '''
+    Builds a leaf evaluator by name for the game configuration config.
+    'solved' uses the values of the solution of config, 'hits' is the
+    HitsEvaluator, and the name of any other game configuration uses the
+    values of its solution through a VariantEvaluator.
+    '''
+    config = game_tables(config).config
+    if name == 'hits':
+        return HitsEvaluator(config)
+    if name == 'solved':
+        name = config.name
+    variant_config = game_configs[name]
+    values = solution_values(load_solution(
+        './solutions/%s_final.b4s'%name, config=variant_config))
+    if variant_config == config:
+        return ValueEvaluator(values, config)
+    return VariantEvaluator(values, variant_config, config)
+
+class MCTSTree:
+    '''
+    The statistics of the node in slot s are stored at visits[s], and for
+    action a at child_visits[18*s + a] and child_values[18*s + a] for p1 and
+    at 18*s + 9 + a for p2.  entries[s] holds these positions for the legal
+    actions of each player, and edges[81*s + 9*a1 + a2] caches the successor
+    of each pair of actions once it has been tried (see child).  Values
+    are always from p1's point of view.
+    rng is a random.Random, and the random module is used if it is None.
+
+    If rollout_depth is given, rollouts stop after that many random turns
+    and the state they reach is scored with evaluator, a function that maps
+    a live packed state to its value, such as a ValueEvaluator.  With a
+    rollout_depth of 0, new nodes are scored with evaluator directly.
+    '''
+    def __init__(
+        self,
+        config=None,
+        c=2**0.5,
+        capacity=2**14,
+        rng=None,
+        rollout_depth=None,
+        evaluator=None,
+    ):
+        if rollout_depth is not None and evaluator is None:
+            raise ValueError('a rollout depth requires an evaluator')
+        tables = game_tables(config)
+        self.tables = tables
+        self.config = tables.config
+        self.c = c
+        self.rand = (random if rng is None else rng).random
+        self.rollout_depth = rollout_depth
+        self.evaluator = evaluator
+
+        # python versions of the tables needed to index and step packed states
+        self.index = PackedIndex(tables)
+        self.legal_actions = {
+            int(code) : tuple(int(a) for a in mask.nonzero()[0])
+            for code, mask in zip(
+                tables.card_state_codes, tables.card_state_action_masks)
+        }
+        self.dead = packed_state.dead_table(self.config).tolist()
+        self.deltas = packed_state.transition_deltas.ravel().tolist()
+        self.terminal_values = packed_state.value_table(self.config).tolist()
+
+        self.slots = {}
+        self.codes = []
+        self.entries = []
+        self.visits = array.array('q', [0]) * capacity
+        self.child_visits = array.array('d', [0.]) * (18 * capacity)
+        self.child_values = array.array('d', [0.]) * (18 * capacity)
+        self.edges = array.array('q', [unexplored]) * (81 * capacity)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def node(self, code, index=None):
+        '''
+        Returns the slot of the node for a live packed state, adding the node
+        if it is not already in the tree.
+        '''
+        if index is None:
+            index = self.index(code)
+        slot = self.slots.get(index)
+        if slot is not None:
+            return slot
+
+        slot = len(self.codes)
+        if slot == len(self.visits):
+            self.visits += array.array('q', [0]) * slot
+            self.child_visits += array.array('d', [0.]) * (18 * slot)
+            self.child_values += array.array('d', [0.]) * (18 * slot)
+            self.edges += array.array('q', [unexplored]) * (81 * slot)
+        self.slots[index] = slot
+        self.codes.append(code)
+
+        # most nodes are only ever reached by the sample that added them, so
+        # their entries are not filled in until they are first selected
+        self.entries.append(None)
+        return slot
+
+    def node_entries(self, slot):
+        '''
+        Returns the positions of the statistics of each legal action of p1
+        and p2 at the node in slot.
+        '''
+        entries = self.entries[slot]
+        if entries is None:
+            code = self.codes[slot]
+            p1_actions = self.legal_actions[(code & player_mask) >> hit_bits]
+            p2_actions = self.legal_actions[code >> (player_bits + hit_bits)]
+            offset = 18*slot
+            entries = (
+                [offset + a for a in p1_actions],
+                [offset + 9 + a for a in p2_actions],
+            )
+            self.entries[slot] = entries
+        return entries
+
+    def rollout(self, code):
+        '''
+        Plays uniformly random actions from a packed state until the game
+        ends or rollout_depth turns have been played, and returns the final
+        value or the evaluator's value of the state it stopped in.
+        '''
+        dead = self.dead
+        deltas = self.deltas
+        legal_actions = self.legal_actions
+        rand = self.rand
+        depth = self.rollout_depth
+        turns = 0
+        while True:
+            p1 = code & player_mask
+            p2 = code >> player_bits
+            p1_dead = dead[p1 & hit_mask]
+            p2_dead = dead[p2 & hit_mask]
+            p1_cards = p1 >> hit_bits
+            p2_cards = p2 >> hit_bits
+            if p1_dead or p2_dead or not p1_cards or not p2_cards:
+                return self.terminal_values[2*p1_dead + p2_dead]
+            if turns == depth:
+                return self.evaluator(code)
+            turns += 1
+            p1_actions = legal_actions[p1_cards]
+            p2_actions = legal_actions[p2_cards]
+            code += deltas[
+                9 * p1_actions[int(rand() * len(p1_actions))] +
+                p2_actions[int(rand() * len(p2_actions))]
+            ]
+
+    def child(self, slot, p1_action, p2_action):
+        '''
+        Returns the edge entry for a pair of actions at the node in slot, and
+        the value of the rollout if this adds a new node.  Edge entries are
+        the slot of the child node for live successors and ~k for terminal
+        successors with value terminal_values[k].
+        '''
+        code = self.codes[slot] + self.deltas[9*p1_action + p2_action]
+        p1 = code & player_mask
+        p2 = code >> player_bits
+        p1_dead = self.dead[p1 & hit_mask]
+        p2_dead = self.dead[p2 & hit_mask]
+        if p1_dead or p2_dead or not p1 >> hit_bits or not p2 >> hit_bits:
+            child = ~(2*p1_dead + p2_dead)
+            value = None
+        else:
+            index = self.index(code)
+            child = self.slots.get(index)
+            value = None
+            if child is None:
+                child = self.node(code, index)
+                value = self.rollout(code)
+        self.edges[81*slot + 9*p1_action + p2_action] = child
+        return child, value
+
+    def sample(self, slot):
+        '''
+        Runs one iteration of the search from the node in slot and returns
+        the value along with the actions p1 and p2 took at that node.
+        '''
+        visits = self.visits
+        child_visits = self.child_visits
+        child_values = self.child_values
+        entries = self.entries
+        edges = self.edges
+        rand = self.rand
+        c = self.c
+        log = math.log
+        inf = math.inf
+        path = []
+        while True:
+            n = visits[slot]
+            if n:
+                p1_entries, p2_entries = entries[slot]
+            else:
+                p1_entries, p2_entries = self.node_entries(slot)
+
+            # Each player tries every action once in a random order, and then
+            # picks the action with the largest UCB.  For p2 this is
+            # 1 - mean + c * log(n) / child_visits, and the 1 can be dropped.
+            # Since each visit adds one try, some actions are untried if and
+            # only if n is less than the number of actions, and one of them
+            # is picked uniformly by drawing until an untried one comes up.
+            if n:
+                exploration = c * log(n)
+            if n < len(p1_entries):
+                p1_entry = p1_entries[int(rand() * len(p1_entries))]
+                while child_visits[p1_entry]:
+                    p1_entry = p1_entries[int(rand() * len(p1_entries))]
+            else:
+                best = -inf
+                for e in p1_entries:
+                    ucb = (exploration + child_values[e]) / child_visits[e]
+                    if ucb > best:
+                        best = ucb
+                        p1_entry = e
+            if n < len(p2_entries):
+                p2_entry = p2_entries[int(rand() * len(p2_entries))]
+                while child_visits[p2_entry]:
+                    p2_entry = p2_entries[int(rand() * len(p2_entries))]
+            else:
+                best = -inf
+                for e in p2_entries:
+                    ucb = (exploration - child_values[e]) / child_visits[e]
+                    if ucb > best:
+                        best = ucb
+                        p2_entry = e
+            path.append((slot, p1_entry, p2_entry))
+
+            p1_action = p1_entry % 18
+            p2_action = p2_entry % 18 - 9
+            child = edges[81*slot + 9*p1_action + p2_action]
+            if child == unexplored:
+                child, value = self.child(slot, p1_action, p2_action)
+                if value is not None:
+                    break
+            if child < 0:
+                value = self.terminal_values[~child]
+                break
+            slot = child
+
+        for slot, p1_entry, p2_entry in path:
+            visits[slot] += 1
+            child_visits[p1_entry] += 1
+            child_values[p1_entry] += value
+            child_visits[p2_entry] += 1
+            child_values[p2_entry] += value
+
+        slot, p1_entry, p2_entry = path[0]
+        return value, p1_entry - 18*slot, p2_entry - 18*slot - 9
+
+    def run(self, slot, samples=None, seconds=None):
+        '''
+        Runs samples from the node in slot until either the number of
+        samples or the number of seconds runs out, and returns the number of
+        samples that were run.  At least one of them must be given.
+        '''
+        sample = self.sample
+        if seconds is None:
+            for i in range(samples):
+                sample(slot)
+            return samples
+
+        deadline = time.perf_counter() + seconds
+        n = 0
+        while (samples is None or n < samples) and (
+            time.perf_counter() < deadline):
+            sample(slot)
+            n += 1
+        return n
+
+    def search(self, code, samples=None, seconds=None):
+        '''
+        Searches from a live packed state (see run) and returns the action
+        p1 picks with one more sample.
+        '''
+        slot = self.node(code)
+        self.run(slot, samples, seconds)
+        _, action, _ = self.sample(slot)
+        return action
+
+    def root_statistics(self, code):
+        '''
+        Returns lists of the visits and total values of each of p1's actions
+        at the node for a packed state, with zeros for illegal actions.
+        '''
+        offset = 18 * self.node(code)
+        return (
+            self.child_visits[offset:offset+9].tolist(),
+            self.child_values[offset:offset+9].tolist(),
+        )
+
+def search_worker(connection, config, c, seed, rollout_depth, evaluator):
+    '''
+    Keeps a tree in a worker process of a RootParallelSearch and searches
+    it for every state it is sent until it is sent None.
+    '''
+    tree = MCTSTree(
+        config,
+        c=c,
+        rng=random.Random(seed),
+        rollout_depth=rollout_depth,
+        evaluator=evaluator,
+    )
+    while True:
+        task = connection.recv()
+        if task is None:
+            break
+        code, samples, seconds = task
+        n = tree.run(tree.node(code), samples, seconds)
+        connection.send((n, *tree.root_statistics(code)))
+    connection.close()
+
+class RootParallelSearch:
+    '''
+    Searches the same state in a separate tree in each of num_procs worker
+    processes and merges the statistics of p1's actions at the root.  Each
+    worker draws from its own random stream, spawned from seed, and keeps
+    its tree between searches, and the evaluator, if there is one, is copied
+    to every worker.  The workers run until close is called or the main
+    process exits.
+    '''
+    def __init__(
+        self,
+        num_procs,
+        config=None,
+        c=2**0.5,
+        seed=None,
+        rollout_depth=None,
+        evaluator=None,
+    ):
+        context = multiprocessing.get_context(None)
+        self.connections = []
+        self.processes = []
+        for seed_sequence in numpy.random.SeedSequence(seed).spawn(num_procs):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(
+                target=search_worker,
+                args=(
+                    worker_connection,
+                    config,
+                    c,
+                    int(seed_sequence.generate_state(1)[0]),
+                    rollout_depth,
+                    evaluator,
+                ),
+                daemon=True,
+            )
+            process.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+    def search(self, code, samples=None, seconds=None):
+        '''
+        Runs a search from a live packed state in every worker (see
+        MCTSTree.run) and returns the total number of samples along with the
+        merged visits and total values of each of p1's actions.
+        '''
+        for connection in self.connections:
+            connection.send((code, samples, seconds))
+        total_samples = 0
+        visits = [0.] * 9
+        values = [0.] * 9
+        for connection in self.connections:
+            n, worker_visits, worker_values = connection.recv()
+            total_samples += n
+            for a in range(9):
+                visits[a] += worker_visits[a]
+                values[a] += worker_values[a]
+        return total_samples, visits, values
+
+    def close(self):
+        for connection in self.connections:
+            connection.send(None)
+            connection.close()
+        for process in self.processes:
+            process.join()
+        self.connections = []
+        self.processes = []
@@ -1,8 +1,9 @@
 import numpy
 
-from scipy.optimize import linprog
-
 def lp_solve_zero_sum(game):
+    # scipy takes a while to import, so it is only loaded by the solver
+    from scipy.optimize import linprog
+    
     opt = linprog(
         numpy.ones(game.shape[1]),
         A_ub=-game,
@@ -24,3 +25,121 @@ def best_response(game, opponent_distribution):
     value = a[i]
     
     return policy, value
+
+def batch_lp_solve_zero_sum(
+    games,
+    row_mask=None,
+    col_mask=None,
+    max_iterations=200,
+    tolerance=1e-9,
+):
+    '''
+    Solves a stack of N zero-sum games at once.  games is an (N,R,C) array
+    laid out the same way as the argument to lp_solve_zero_sum (the column
+    player is the maximizing player) and row_mask/col_mask are (N,R) and
+    (N,C) boolean arrays marking which actions are legal.  Entries for
+    illegal actions are ignored and may be nan.  All legal payoffs must be
+    positive, which is always true for Bodega Brawl values.
+    
+    This solves the same linear program as lp_solve_zero_sum (in its dual
+    form) with a tableau simplex that runs on every game in lockstep, using
+    Bland's rule so degenerate games cannot cycle.  Returns an (N,C) policy
+    array with zeros for illegal actions, an (N,) value array, the (N,R)
+    equilibrium policy of the row player, and an (N,) boolean array that is
+    False for any game that did not converge to a verified equilibrium.
+    Values match linprog to within tolerance, but when a game has more than
+    one equilibrium the policies may be a different one.
+    '''
+    games = numpy.asarray(games, dtype=numpy.float64)
+    n, r, c = games.shape
+    if row_mask is None:
+        row_mask = numpy.ones((n, r), dtype=bool)
+    if col_mask is None:
+        col_mask = numpy.ones((n, c), dtype=bool)
+    legal = row_mask[:,:,None] & col_mask[:,None,:]
+    masked_games = numpy.where(legal, games, 0.)
+    
+    # Build the tableau for: maximize sum(y) s.t. games.T @ y <= 1, y >= 0.
+    # Columns are [y (r) | slack (c) | rhs], rows are [constraints (c) | obj].
+    tableau = numpy.zeros((n, c+1, r+c+1))
+    tableau[:,:c,:r] = masked_games.transpose(0,2,1)
+    tableau[:,:c,r:r+c] = numpy.eye(c)
+    tableau[:,:c,-1] = 1.
+    tableau[:,c,:r] = -row_mask.astype(numpy.float64)
+    basis = numpy.broadcast_to(numpy.arange(r, r+c), (n, c)).copy()
+    
+    success = numpy.ones(n, dtype=bool)
+    active = numpy.arange(n)
+    for iteration in range(max_iterations):
+        if not active.shape[0]:
+            break
+        t = tableau[active]
+        
+        # Bland's rule: enter the lowest index column that improves
+        improving = t[:,c,:-1] < -tolerance
+        finished = ~improving.any(axis=1)
+        active = active[~finished]
+        t = t[~finished]
+        if not active.shape[0]:
+            break
+        entering = numpy.argmax(improving[~finished], axis=1)
+        
+        # ratio test, breaking ties by the lowest index basic variable
+        rows = numpy.arange(active.shape[0])
+        column = t[rows,:c,entering]
+        positive = column > tolerance
+        ratios = numpy.full(column.shape, numpy.inf)
+        ratios[positive] = t[:,:c,-1][positive] / column[positive]
+        min_ratio = ratios.min(axis=1, keepdims=True)
+        unbounded = ~numpy.isfinite(min_ratio[:,0])
+        if numpy.any(unbounded):
+            success[active[unbounded]] = False
+            keep = ~unbounded
+            active, t, entering = active[keep], t[keep], entering[keep]
+            ratios, min_ratio = ratios[keep], min_ratio[keep]
+            rows = numpy.arange(active.shape[0])
+        ties = ratios <= min_ratio + tolerance * (1. + numpy.abs(min_ratio))
+        tied_basis = numpy.where(ties, basis[active], r+c)
+        leaving = numpy.argmin(tied_basis, axis=1)
+        
+        # pivot
+        pivot_row = t[rows,leaving] / t[rows,leaving,entering][:,None]
+        t -= t[rows,:,entering][:,:,None] * pivot_row[:,None,:]
+        t[rows,leaving] = pivot_row
+        tableau[active] = t
+        basis[active, leaving] = entering
+    else:
+        success[active] = False
+    
+    # the column player's strategy is read from the objective row under the
+    # slack columns, the row player's strategy from the basic y variables,
+    # and the objective is 1/value
+    objective = tableau[:,c,-1]
+    y = numpy.zeros((n, r+c))
+    y[numpy.arange(n)[:,None], basis] = tableau[:,:c,-1]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        value = 1. / objective
+        policy = numpy.where(
+            col_mask, tableau[:,c,r:r+c] * value[:,None], 0.)
+        opponent_policy = numpy.where(row_mask, y[:,:r] * value[:,None], 0.)
+    
+    # verify that each policy guarantees the value against every legal action
+    guaranteed = numpy.where(
+        row_mask, numpy.einsum('nrc,nc->nr', masked_games, policy), numpy.inf)
+    conceded = numpy.where(
+        col_mask,
+        numpy.einsum('nrc,nr->nc', masked_games, opponent_policy),
+        -numpy.inf,
+    )
+    # small negative entries are round-off like any other and are clipped
+    # below, so they are held to the same 1e-6 as the rest of the checks
+    success &= numpy.isfinite(value)
+    for p in policy, opponent_policy:
+        success &= numpy.all(p >= -1e-6, axis=1)
+        success &= numpy.abs(p.sum(axis=1) - 1.) <= 1e-6
+    success &= guaranteed.min(axis=1) >= value - 1e-6
+    success &= conceded.max(axis=1) <= value + 1e-6
+    policy = numpy.maximum(policy, 0.)
+    opponent_policy = numpy.maximum(opponent_policy, 0.)
+    
+    return policy, value, opponent_policy, success
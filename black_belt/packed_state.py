@@ -0,0 +1,172 @@
+import numpy
+
+from black_belt.bodega_brawl import (
+    State,
+    action_order,
+    default_config,
+    game_types,
+)
+
+'''
+A compact encoding of the Bodega Brawl game state for fast simulation.  A full
+State is 18 small counters laid out in the same order as State.flat:
+[0:3] p1 hit state, [3:9] p1 card state, [9:12] p2 hit state and
+[12:18] p2 card state.  No counter ever exceeds 7, so each one is packed into
+3 bits of a single integer, with counter i stored at bit 3*i.  The packed
+integers fit comfortably in an int64, so batches of states are int64 arrays.
+
+Actions are referred to by their integer index (int(action)).  Every function
+in this module works on a single packed integer or on a numpy array of them.
+Functions that depend on the rules of the game take an optional GameConfig,
+and use the default configuration if none is given.
+'''
+
+bits_per_counter = 3
+counter_mask = (1 << bits_per_counter) - 1
+num_counters = 18
+player_bits = 9 * bits_per_counter
+player_mask = (1 << player_bits) - 1
+hit_bits = 3 * bits_per_counter
+hit_mask = (1 << hit_bits) - 1
+card_mask = player_mask ^ hit_mask
+counter_shifts = (
+    numpy.arange(num_counters, dtype=numpy.int64) * bits_per_counter)
+
+def pack_rows(rows):
+    '''
+    Packs an (N,18) array of counters into an array of N int64 codes.
+    '''
+    rows = numpy.asarray(rows, dtype=numpy.int64).reshape(-1, num_counters)
+    return numpy.bitwise_or.reduce(rows << counter_shifts, axis=1)
+
+def unpack_rows(codes):
+    '''
+    Unpacks an array of N int64 codes into an (N,18) uint8 array of counters.
+    '''
+    codes = numpy.asarray(codes, dtype=numpy.int64).reshape(-1, 1)
+    return ((codes >> counter_shifts) & counter_mask).astype(numpy.uint8)
+
+def pack_state(state):
+    '''
+    Packs a State into a single integer.
+    '''
+    code = 0
+    for i, c in enumerate(state.flat):
+        code |= c << (i * bits_per_counter)
+    return code
+
+def unpack_state(code, config=None):
+    '''
+    Unpacks a single integer into a State.
+    '''
+    types = game_types(config)
+    code = int(code)
+    c = [(code >> (i * bits_per_counter)) & counter_mask
+        for i in range(num_counters)]
+    p1 = types.PlayerState(types.HitState(*c[0:3]), types.CardState(*c[3:9]))
+    p2 = types.PlayerState(types.HitState(*c[9:12]), types.CardState(*c[12:18]))
+    return types.State(p1, p2)
+
+def mirror(codes):
+    '''
+    Swaps the roles of p1 and p2, the packed equivalent of State(p2, p1).
+    '''
+    return (codes >> player_bits) | ((codes & player_mask) << player_bits)
+
+# build the transition tables by running every pair of actions through the
+# reference State.transition so the two can never disagree.  The deltas do not
+# depend on the rules of the game.
+initial_state = State()
+initial_code = pack_state(initial_state)
+transition_deltas = numpy.zeros((9, 9), dtype=numpy.int64)
+for a1 in action_order:
+    for a2 in action_order:
+        successor = initial_state.transition((a1, a2))
+        transition_deltas[int(a1), int(a2)] = (
+            pack_state(successor) - initial_code)
+
+# action_card_shifts[a] is the bit offset of the card counter that action a
+# consumes within a single player's bits
+action_card_shifts = numpy.array([
+    (3 + ('head_a', 'head_ac', 'body_a', 'body_ac', 'legs_a', 'legs_ac').index(
+        a.card_name())) * bits_per_counter
+    for a in action_order
+], dtype=numpy.int64)
+
+# dead_tables[config][h] tells whether a player whose packed hit counters are
+# h is dead under the rules of config
+dead_tables = {}
+
+def dead_table(config=None):
+    if config is None:
+        config = default_config
+    if config not in dead_tables:
+        hit_state = game_types(config).HitState
+        table = numpy.zeros(1 << hit_bits, dtype=bool)
+        for h in range(1 << hit_bits):
+            head, body, legs = (
+                (h >> (i * bits_per_counter)) & counter_mask for i in range(3))
+            table[h] = hit_state(head, body, legs).is_dead
+        dead_tables[config] = table
+    return dead_tables[config]
+
+def transition(codes, a1, a2):
+    '''
+    Returns the successor of codes when p1 plays action a1 and p2 plays a2.
+    '''
+    return codes + transition_deltas[a1, a2]
+
+def p1_dead(codes, config=None):
+    return dead_table(config)[codes & hit_mask]
+
+def p2_dead(codes, config=None):
+    return dead_table(config)[(codes >> player_bits) & hit_mask]
+
+def terminal(codes, config=None):
+    return (
+        p1_dead(codes, config) |
+        p2_dead(codes, config) |
+        ((codes & card_mask) == 0) |
+        (((codes >> player_bits) & card_mask) == 0)
+    )
+
+def value_table(config=None):
+    '''
+    Returns an array where entry 2*p1_dead + p2_dead matches State.value for
+    terminal states.
+    '''
+    if config is None:
+        config = default_config
+    win, loss, draw = config.payoffs
+    return numpy.array([draw, win, loss, draw])
+
+def value(codes, config=None):
+    '''
+    Returns the value of terminal states.  Unlike State.value, non-terminal
+    states are given a value of nan instead of None so that batches can be
+    processed as a single array.
+    '''
+    v = value_table(config)[
+        2*p1_dead(codes, config).astype(numpy.int64) + p2_dead(codes, config)]
+    return numpy.where(terminal(codes, config), v, numpy.nan)
+
+def action_masks(codes):
+    '''
+    Returns two boolean arrays with a trailing dimension of 9 indicating which
+    actions are available to p1 and p2.
+    '''
+    codes = numpy.asarray(codes, dtype=numpy.int64)[..., None]
+    p1_mask = ((codes >> action_card_shifts) & counter_mask) != 0
+    p2_mask = ((codes >> (action_card_shifts + player_bits)) &
+        counter_mask) != 0
+    return p1_mask, p2_mask
+
+def action_space(code):
+    '''
+    Returns the integer actions available to p1 and p2 for a single state.
+    '''
+    p1_mask, p2_mask = action_masks(code)
+    return (
+        tuple(int(a) for a in numpy.flatnonzero(p1_mask)),
+        tuple(int(a) for a in numpy.flatnonzero(p2_mask)),
+    )
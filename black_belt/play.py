@@ -1,35 +1,45 @@
 import random
-import pickle
 import argparse
 
-from black_belt.bodega_brawl import State, game_mode
-from black_belt.game_statistics import state_to_index
-from black_belt.agent import SolvedAgent
+from black_belt.bodega_brawl import game_mode, game_configs
+from black_belt.agent import SolvedAgent, PolicyServerAgent
 
 '''
-Interactively play against the computer.  Two flags:
+Interactively play against the computer.  Four flags:
+--mode : The game configuration to play, which must have been solved already.
 --drive : When this flag is set, the script will show the computer's moves
 before asking for the player input.  This is useful for when one human is
 using this script to play the game against another human using physical cards.
 --verbose : Will show the computer's action probabilities and value estimates
 when playing.
+--server : Play the solution served by a running b4_policy_server at this
+address instead of loading it.
 '''
 
 parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--mode', type=str, default=game_mode, choices=tuple(game_configs),
+    help='The game configuration to play.')
 parser.add_argument(
     '--drive', action='store_true',
     help='For use when playing against another human with physical cards.')
 parser.add_argument(
     '--verbose', action='store_true',
     help='Shows action probabilities and value estimates')
+parser.add_argument(
+    '--server', type=str, default=None,
+    help='The address of a b4_policy_server to play through.')
 
-def play(drive=False, verbose=False):
+def play(config=None, drive=False, verbose=False, server=None):
     
     # load agent
-    agent = SolvedAgent('./solutions/%s_final.pkl'%game_mode)
+    if server is not None:
+        agent = PolicyServerAgent(server, config=config)
+    else:
+        agent = SolvedAgent(config=config)
     
     # initialize the game state
-    state = State()
+    state = agent.config.initial_state()
     
     # continue until terminal
     while not state.terminal:
@@ -56,7 +66,7 @@ def play(drive=False, verbose=False):
             print()
         
         # get the recommended policy for the human
-        opposite_state = State(state.p2, state.p1)
+        opposite_state = state.mirror()
         recommended_policy = agent.policy(opposite_state)
         
         # pick an action for player 2
@@ -68,7 +78,7 @@ def play(drive=False, verbose=False):
             else:
                 print('%i: %s'%(i, p2_action))
         if verbose:
-            print('V: %0.4f'%agent.data['v'][opposite_state_index])
+            print('V: %0.4f'%agent.value(opposite_state))
             print()
         
         # get the user's input
@@ -93,7 +103,12 @@ def play_commandline():
     # parse args
     args = parser.parse_args()
     
-    play(drive=args.drive, verbose=args.verbose)
+    play(
+        config=game_configs[args.mode],
+        drive=args.drive,
+        verbose=args.verbose,
+        server=args.server,
+    )
 
 if __name__ == '__main__':
     play_commandline()
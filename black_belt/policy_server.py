@@ -0,0 +1,349 @@
+import os
+import json
+import signal
+import time
+import socket
+import asyncio
+import argparse
+import collections
+
+import numpy
+
+from black_belt.bodega_brawl import game_configs, default_config
+from black_belt.solution_file import load_solution
+from black_belt.simulate import sample_actions
+
+'''
+A long running server that loads a solution once and answers queries about
+it for any number of local clients, so that many bots and analysis jobs can
+share one copy of the solution instead of each loading their own.
+
+The server listens on a Unix socket, or on a localhost TCP port if the
+address is given as host:port.  Each message in either direction is one line
+of json.  A request is an object with an "op" and, for lookups, a list of
+"states" in the string form of State.serialize:
+
+    {"id" : 7, "op" : "policy", "states" : ["0,0,0,1,2,...", ...]}
+
+The response echoes the id and holds one entry per state:
+    policy : "policies", p1's probability of each of the nine actions
+    value  : "values", the value of the state for p1
+    sample : "actions", an action (see bodega_brawl.action_order) drawn from
+             p1's policy
+    info   : the game mode and the path of the solution
+    stats  : request counts, batch sizes and latency percentiles
+A request that fails gets back an "error" message instead.
+
+Requests are answered in order on each connection.  Lookups from all of the
+connections are queued and answered together, so that many small requests
+that arrive at the same time share a single vectorized lookup.
+'''
+
+default_address = './solutions/policy_server.sock'
+
+# the longest request line, about 25 bytes per state
+max_line_bytes = 2**28
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    'path', type=str, nargs='?', default=None,
+    help='The solution to serve.  Defaults to solutions/<mode>_final.b4s.')
+parser.add_argument(
+    '--mode', type=str, default=None, choices=tuple(game_configs),
+    help='The game configuration of the solution.  Read from the solution '
+    'file if not given.')
+parser.add_argument(
+    '--address', type=str, default=default_address,
+    help='The Unix socket to listen on, or host:port to listen on TCP.')
+parser.add_argument(
+    '--max-batch', type=int, default=2**16,
+    help='The largest number of states looked up at once.')
+parser.add_argument(
+    '--stats-interval', type=float, default=60.,
+    help='Print the latency statistics this often in seconds, or never if '
+    '0.')
+parser.add_argument(
+    '--seed', type=int, default=None,
+    help='Seed for the random number generator used to sample actions.')
+
+def parse_address(address):
+    '''
+    Returns (host, port) for a TCP address written as host:port, or None for
+    a Unix socket path.
+    '''
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and '/' not in address:
+        return host or 'localhost', int(port)
+    return None
+
+def parse_states(states, config):
+    '''
+    Converts a list of serialized states to an (N,18) array laid out like
+    State.flat, raising a ValueError unless every state is a live state of
+    the game described by config.
+    '''
+    if not isinstance(states, list) or not all(
+        isinstance(s, str) for s in states):
+        raise ValueError('states must be a list of serialized states')
+    rows = [s.split(',') for s in states]
+    if any(len(row) != 18 for row in rows):
+        raise ValueError('serialized states must have 18 counters')
+    flat = numpy.array(rows, dtype=numpy.int64).reshape(-1, 18)
+
+    hit_limits = numpy.array(
+        [config.max_head_hits, config.max_body_hits, config.max_legs_hits])
+    card_limits = numpy.array(config.start_cards)
+    limits = numpy.concatenate(
+        (hit_limits - 1, card_limits, hit_limits - 1, card_limits))
+    if numpy.any(flat < 0) or numpy.any(flat > limits):
+        raise ValueError('state counters out of range for the %s game'%(
+            config.name))
+    p1_cards = flat[:,3:9].sum(axis=1)
+    p2_cards = flat[:,12:18].sum(axis=1)
+    if numpy.any(p1_cards != p2_cards) or numpy.any(p1_cards == 0):
+        raise ValueError('both players must hold the same number of cards, '
+            'and at least one')
+    if numpy.any(flat[:,0:3].sum(axis=1) >= config.max_total_hits) or (
+        numpy.any(flat[:,9:12].sum(axis=1) >= config.max_total_hits)):
+        raise ValueError('states must be live states of the %s game'%(
+            config.name))
+    return flat
+
+class ServerStats:
+    '''
+    Counts the requests and keeps the latencies of the most recent ones.
+    '''
+    def __init__(self, window=10000):
+        self.start_time = time.time()
+        self.requests = collections.Counter()
+        self.states = collections.Counter()
+        self.errors = 0
+        self.batches = 0
+        self.batch_states = 0
+        self.latencies = collections.deque(maxlen=window)
+
+    def record(self, op, num_states, seconds):
+        self.requests[op] += 1
+        self.states[op] += num_states
+        self.latencies.append(seconds)
+
+    def summary(self):
+        latencies = numpy.array(self.latencies) * 1000.
+        if not len(latencies):
+            latencies = numpy.zeros(1)
+        p50, p90, p99 = numpy.percentile(latencies, [50, 90, 99])
+        return {
+            'uptime_seconds' : time.time() - self.start_time,
+            'requests' : dict(self.requests),
+            'states' : dict(self.states),
+            'errors' : self.errors,
+            'batches' : self.batches,
+            'mean_batch_states' : self.batch_states / max(self.batches, 1),
+            'latency_ms' : {
+                'mean' : float(latencies.mean()),
+                'p50' : float(p50),
+                'p90' : float(p90),
+                'p99' : float(p99),
+                'max' : float(latencies.max()),
+            },
+        }
+
+class PolicyServer:
+    def __init__(self, path, config=None, max_batch=2**16, rng=None):
+        self.path = path
+        self.solution = load_solution(path, config=config)
+        self.tables = self.solution.tables
+        self.max_batch = max_batch
+        self.rng = numpy.random.default_rng() if rng is None else rng
+        self.stats = ServerStats()
+        self.queue = None
+
+    def info(self):
+        return {
+            'game_mode' : self.solution.config.name,
+            'path' : self.path,
+        }
+
+    async def lookup(self, op, states):
+        '''
+        Queues a lookup and waits for the batcher to answer it.
+        '''
+        if not states:
+            return []
+        indices = self.tables.states_to_indices(
+            parse_states(states, self.solution.config))
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((op, indices, future))
+        return await future
+
+    async def batcher(self):
+        '''
+        Answers everything that has been queued since the last batch with one
+        value lookup and one policy lookup.  A failed batch is passed on to
+        the requests in it, so the batcher itself never stops.  Requests whose
+        clients have gone away are skipped.
+        '''
+        while True:
+            batch = [await self.queue.get()]
+            size = len(batch[0][1])
+            while not self.queue.empty() and size < self.max_batch:
+                batch.append(self.queue.get_nowait())
+                size += len(batch[-1][1])
+            batch = [b for b in batch if not b[2].done()]
+            self.stats.batches += 1
+            self.stats.batch_states += size
+            try:
+                self.answer(batch)
+            except Exception as e:
+                print('Failed to answer a batch of %i states: %r'%(size, e),
+                    flush=True)
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def answer(self, batch):
+        values = [b for b in batch if b[0] == 'value']
+        policies = [b for b in batch if b[0] != 'value']
+        for group, lookup in (
+            (values, self.solution.value),
+            (policies, self.solution.policy),
+        ):
+            if not group:
+                continue
+            results = lookup(numpy.concatenate([g[1] for g in group]))
+            start = 0
+            for op, indices, future in group:
+                result = results[start:start+len(indices)]
+                start += len(indices)
+                if op == 'sample':
+                    result = sample_actions(result, self.rng)
+                if not future.done():
+                    future.set_result(result.tolist())
+
+    async def respond(self, request):
+        op = request.get('op')
+        response = {'id' : request.get('id')}
+        if op == 'policy':
+            response['policies'] = await self.lookup(op, request['states'])
+        elif op == 'value':
+            response['values'] = await self.lookup(op, request['states'])
+        elif op == 'sample':
+            response['actions'] = await self.lookup(op, request['states'])
+        elif op == 'info':
+            response.update(self.info())
+        elif op == 'stats':
+            response.update(self.stats.summary())
+        else:
+            raise ValueError('unknown op %s'%op)
+        return response
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                start = time.perf_counter()
+                request = {}
+                try:
+                    request = json.loads(line)
+                    response = await self.respond(request)
+                except Exception as e:
+                    self.stats.errors += 1
+                    response = {'id' : request.get('id'), 'error' : str(e)}
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+                self.stats.record(
+                    request.get('op'),
+                    len(request.get('states', ())),
+                    time.perf_counter() - start,
+                )
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def report(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            print(json.dumps(self.stats.summary()), flush=True)
+
+    async def serve(self, address=default_address, stats_interval=60.):
+        self.queue = asyncio.Queue()
+        tcp = parse_address(address)
+        if tcp is None:
+            if os.path.exists(address):
+                os.remove(address)
+            server = await asyncio.start_unix_server(
+                self.handle, address, limit=max_line_bytes)
+        else:
+            server = await asyncio.start_server(
+                self.handle, *tcp, limit=max_line_bytes)
+        # stop cleanly on SIGTERM so that the socket file is removed
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, server.close)
+        tasks = [asyncio.create_task(self.batcher())]
+        if stats_interval:
+            tasks.append(asyncio.create_task(self.report(stats_interval)))
+        print('Serving %s on %s'%(self.path, address), flush=True)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            if tcp is None and os.path.exists(address):
+                os.remove(address)
+
+class PolicyClient:
+    '''
+    A blocking connection to a PolicyServer.
+    '''
+    def __init__(self, address=default_address):
+        tcp = parse_address(address)
+        if tcp is None:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(address)
+        else:
+            self.socket = socket.create_connection(tcp)
+        self.file = self.socket.makefile('rwb')
+        self.next_id = 0
+
+    def request(self, op, states=None):
+        request = {'id' : self.next_id, 'op' : op}
+        self.next_id += 1
+        if states is not None:
+            request['states'] = states
+        self.file.write(json.dumps(request).encode() + b'\n')
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError('the policy server closed the connection')
+        response = json.loads(line)
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+def policy_server_commandline():
+    args = parser.parse_args()
+    config = None if args.mode is None else game_configs[args.mode]
+    path = args.path
+    if path is None:
+        path = './solutions/%s_final.b4s'%(config or default_config).name
+    server = PolicyServer(
+        path,
+        config=config,
+        max_batch=args.max_batch,
+        rng=numpy.random.default_rng(args.seed),
+    )
+    try:
+        asyncio.run(server.serve(args.address, args.stats_interval))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+if __name__ == '__main__':
+    policy_server_commandline()
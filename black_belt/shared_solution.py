@@ -0,0 +1,119 @@
+import weakref
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+import numpy
+
+from black_belt.solution_file import SolutionFile, PickledSolution
+
+'''
+Publishes a loaded solution in a single block of shared memory so that any
+number of worker processes can look states up in it without each holding a
+copy.  This matters most for solutions in the original pickle format, which
+would otherwise be read into memory again by every worker, and it also works
+with processes that are spawned rather than forked.
+
+The process that creates a SharedSolution owns the shared memory.  Workers
+are given the small, picklable handle from SharedSolution.handle and call
+attach on it, which returns a solution with the usual interface whose arrays
+are read-only numpy views of the shared memory.  The memory is released when
+the owner calls close, is garbage collected or exits.  If the owner is killed
+before it can clean up, multiprocessing's resource tracker releases it.
+'''
+
+# every array starts on a cache line
+alignment = 64
+
+def release(memory):
+    memory.close()
+    memory.unlink()
+
+class SharedArrays:
+    '''
+    Copies a dict of arrays into one new block of shared memory.
+    '''
+    def __init__(self, arrays):
+        self.layout = []
+        size = 0
+        for name, array in arrays.items():
+            size = -(-size // alignment) * alignment
+            self.layout.append((name, array.dtype.str, array.shape, size))
+            size += array.nbytes
+        self.memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for name, dtype, shape, offset in self.layout:
+            numpy.ndarray(
+                shape, dtype=dtype, buffer=self.memory.buf, offset=offset
+            )[...] = arrays[name]
+        self.finalizer = weakref.finalize(self, release, self.memory)
+
+    def close(self):
+        self.finalizer()
+
+def attach_arrays(name, layout):
+    '''
+    Opens the shared memory created by a SharedArrays and returns it along
+    with a dict of read-only views of its arrays.  The memory must be kept
+    alive for as long as the views are used.
+    '''
+    memory = shared_memory.SharedMemory(name=name)
+    arrays = {}
+    for array_name, dtype, shape, offset in layout:
+        array = numpy.ndarray(
+            shape, dtype=dtype, buffer=memory.buf, offset=offset)
+        array.flags.writeable = False
+        arrays[array_name] = array
+    return memory, arrays
+
+class SharedSolutionHandle(namedtuple(
+    'SharedSolutionHandle',
+    ('kind', 'path', 'config', 'name', 'layout', 'extra'),
+)):
+    def attach(self):
+        memory, arrays = attach_arrays(self.name, self.layout)
+        if self.kind == 'file':
+            solution = SolutionFile(
+                self.path, config=self.config, arrays=arrays)
+        else:
+            data = dict(self.extra)
+            data.update(arrays)
+            solution = PickledSolution(
+                self.path, config=self.config, data=data)
+        solution.shared_memory = memory
+        return solution
+
+class SharedSolution:
+    '''
+    Copies the arrays of a SolutionFile or PickledSolution into shared
+    memory.
+    '''
+    def __init__(self, solution):
+        self.path = solution.path
+        self.config = solution.config
+        if isinstance(solution, SolutionFile):
+            self.kind = 'file'
+            arrays = solution.arrays
+            self.extra = {}
+        else:
+            self.kind = 'pickle'
+            arrays = {
+                name : array for name, array in solution.data.items()
+                if isinstance(array, numpy.ndarray)
+            }
+            self.extra = {
+                name : value for name, value in solution.data.items()
+                if name not in arrays
+            }
+        self.arrays = SharedArrays(arrays)
+
+    def handle(self):
+        return SharedSolutionHandle(
+            self.kind,
+            self.path,
+            self.config,
+            self.arrays.memory.name,
+            self.arrays.layout,
+            self.extra,
+        )
+
+    def close(self):
+        self.arrays.close()
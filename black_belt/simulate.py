@@ -0,0 +1,72 @@
+import numpy
+
+from black_belt import packed_state
+from black_belt.game_statistics import game_tables
+
+'''
+Plays many games of Bodega Brawl at once.  Instead of stepping through one
+game at a time with State objects, a whole batch of games is kept as an array
+of packed states (see packed_state.py) and advanced in lockstep.  Each turn,
+both players' policies for every active game are looked up with a single call
+to Agent.policies, one action is drawn per game with a single vectorized draw
+and the games that have ended are dropped from the batch.
+'''
+
+def sample_actions(policies, rng):
+    '''
+    Draws one action from each row of an (N,9) array of policies.  Actions
+    with zero probability are never drawn, even if the rows do not sum to
+    exactly one.
+    '''
+    cumulative = numpy.cumsum(policies, axis=1)
+    thresholds = rng.random(len(policies)) * cumulative[:,-1]
+    return numpy.argmax(cumulative > thresholds[:,None], axis=1)
+
+def simulate(
+    agent,
+    opponent,
+    games,
+    config=None,
+    rng=None,
+    batch_size=2**16,
+    progress=False,
+):
+    '''
+    Plays a number of games with agent as p1 and opponent as p2, and returns
+    an array with the final value of each game.  rng is a
+    numpy.random.Generator, a new unseeded one is used if it is not given.
+    '''
+    tables = game_tables(config)
+    config = tables.config
+    if rng is None:
+        rng = numpy.random.default_rng()
+    initial_code = packed_state.pack_state(config.initial_state())
+
+    values = numpy.empty(games)
+    if progress:
+        import tqdm
+        progress = tqdm.tqdm(total=games)
+    for start in range(0, games, batch_size):
+        end = min(start + batch_size, games)
+        codes = numpy.full(end - start, initial_code, dtype=numpy.int64)
+        active = numpy.arange(start, end)
+        while len(active):
+            indices = tables.codes_to_indices(codes)
+            p1_actions = sample_actions(
+                agent.policies(indices, tables), rng)
+            p2_actions = sample_actions(
+                opponent.policies(tables.mirror_indices(indices), tables), rng)
+            codes = packed_state.transition(codes, p1_actions, p2_actions)
+
+            # record and drop the games that have finished
+            terminal = packed_state.terminal(codes, config)
+            values[active[terminal]] = packed_state.value(
+                codes[terminal], config)
+            codes = codes[~terminal]
+            active = active[~terminal]
+            if progress:
+                progress.update(int(terminal.sum()))
+
+    if progress:
+        progress.close()
+    return values
@@ -0,0 +1,115 @@
+import numpy
+
+'''
+A cache of zero-sum game solutions that can be shared by all of the solver's
+worker processes.  Many game states produce exactly the same payoff matrix
+(for example when every successor is terminal), so each matrix is reduced to
+a canonical key and the solution is only computed once.
+
+The cache lives in shared memory allocated before the workers are forked.  It
+is direct-mapped: each key hashes to a single slot, and inserting a new key
+into an occupied slot evicts the previous entry, so the memory footprint is
+fixed no matter how long the solve runs.  Lookups and inserts are
+vectorized.  Inserts hold a lock so that two writers never fill the same slot
+at once, but lookups do not lock.  Instead, writers clear a slot's key before
+writing its entry and set the key afterward, and readers check the key both
+before and after copying an entry.
+'''
+
+# each entry stores the value followed by the policies of both players
+entry_size = 1 + 9 + 9
+
+# random odd multipliers for the two 64-bit halves of each key
+key_multipliers = numpy.random.default_rng(0x6234).integers(
+    0, 2**63, size=(2, 81+18), dtype=numpy.uint64) * 2 + 1
+
+class SolutionCache:
+    def __init__(self, size, context, quantum=2.**-40):
+        self.size = size
+        self.quantum = quantum
+        self.keys = context.RawArray('Q', size*2)
+        self.entries = context.RawArray('d', size*entry_size)
+        self.lock = context.Lock()
+
+    def make_keys(self, games):
+        '''
+        Computes a 128-bit key for each payoff matrix in an (N,9,9) array
+        where illegal action pairs are nan.  Payoffs are quantized to
+        multiples of quantum so that round-off does not split identical games,
+        and the row and column action masks are included in the key.  Returns
+        an (N,2) uint64 array.
+        '''
+        illegal = numpy.isnan(games)
+        quantized = numpy.where(
+            illegal, -1, numpy.round(numpy.nan_to_num(games) / self.quantum)
+        ).astype(numpy.int64)
+        masks = numpy.concatenate(
+            (~illegal.all(axis=2), ~illegal.all(axis=1)), axis=1)
+        data = numpy.concatenate(
+            (quantized.reshape(-1, 81), masks.astype(numpy.int64)), axis=1
+        ).view(numpy.uint64)
+        keys = numpy.stack(
+            [(data * m).sum(axis=1, dtype=numpy.uint64)
+             for m in key_multipliers],
+            axis=1,
+        )
+
+        # a key of zero marks an empty slot
+        keys[(keys[:,0] == 0) & (keys[:,1] == 0), 0] = 1
+        return keys
+
+    def arrays(self):
+        keys = numpy.frombuffer(self.keys, dtype=numpy.uint64).reshape(-1, 2)
+        entries = numpy.frombuffer(
+            self.entries, dtype=numpy.float64).reshape(-1, entry_size)
+        return keys, entries
+
+    def slots(self, keys):
+        '''
+        Maps an (N,2) array of keys to their slots.  The keys are linear in
+        the payoffs, so their low bits only depend on the low bits of the
+        payoffs, and payoffs that are multiples of a power of two would
+        crowd into a few slots.  The first half of each key goes through the
+        splitmix64 finalizer first so that every bit of it affects the slot.
+        '''
+        mixed = keys[:,0].copy()
+        mixed ^= mixed >> numpy.uint64(30)
+        mixed *= numpy.uint64(0xbf58476d1ce4e5b9)
+        mixed ^= mixed >> numpy.uint64(27)
+        mixed *= numpy.uint64(0x94d049bb133111eb)
+        mixed ^= mixed >> numpy.uint64(31)
+        return mixed % numpy.uint64(self.size)
+
+    def lookup(self, keys):
+        '''
+        Looks up an (N,2) array of keys.  Returns an (N,) boolean array that
+        is True for each key found in the cache and an (N,19) array of the
+        cached values and policies (see split_entries).
+        '''
+        cache_keys, cache_entries = self.arrays()
+        slots = self.slots(keys)
+        found = numpy.all(cache_keys[slots] == keys, axis=1)
+        entries = cache_entries[slots]
+        found &= numpy.all(cache_keys[slots] == keys, axis=1)
+        entries[~found] = 0.
+        return found, entries
+
+    def insert(self, keys, entries):
+        '''
+        Inserts an (N,2) array of keys with their (N,19) entries, evicting
+        whatever was previously stored in their slots.
+        '''
+        cache_keys, cache_entries = self.arrays()
+        slots = self.slots(keys)
+        slots, first = numpy.unique(slots, return_index=True)
+        with self.lock:
+            cache_keys[slots] = 0
+            cache_entries[slots] = entries[first]
+            cache_keys[slots] = keys[first]
+
+def make_entries(policy, value, opponent_policy):
+    return numpy.concatenate(
+        (value[:,None], policy, opponent_policy), axis=1)
+
+def split_entries(entries):
+    return entries[:,1:10], entries[:,0], entries[:,10:19]
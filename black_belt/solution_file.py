@@ -0,0 +1,480 @@
+import os
+import json
+import pickle
+import argparse
+
+import numpy
+
+from black_belt.bodega_brawl import (
+    GameConfig,
+    game_configs,
+    game_mode,
+    default_config,
+    standard_payoffs,
+)
+from black_belt.game_statistics import game_tables, MirroredValues
+
+'''
+Reads and writes solutions in a compact, versioned binary format that can be
+memory mapped, so that loading a solution is nearly instant and several
+processes can share the same pages.  A solution file is laid out as:
+
+magic (8 bytes) | json header (padded to header_size) | arrays
+
+The header records the name, rules and payoffs of the game configuration the
+solution was computed for, the number of states, whether the solution is
+symmetric (see solve.py), how the arrays were quantized along with the
+largest error that introduced, and the dtype, shape and byte offset of each
+array.  The header is padded to a fixed size so that it can be rewritten in
+place.
+
+The arrays are:
+v : the value of each stored state
+p : the policy of p1 in each stored state, with only the entries for legal
+    actions stored, one state after another
+p_block_starts, p_block_offsets, p_block_widths : runs of consecutive states
+    that have the same number of legal actions.  The policy of the state at
+    position i in run b starts at p_block_offsets[b] +
+    (i - p_block_starts[b]) * p_block_widths[b].
+Symmetric solutions also have p2, p2_block_starts, p2_block_offsets and
+p2_block_widths for the policy of p2 in each canonical state.
+'''
+
+magic = b'B4SOLN\x00\x00'
+format_version = 1
+header_size = 4096
+array_alignment = 64
+
+rule_names = (
+    'max_head_hits',
+    'max_body_hits',
+    'max_legs_hits',
+    'max_total_hits',
+    'start_head_a',
+    'start_head_ac',
+    'start_body_a',
+    'start_body_ac',
+    'start_legs_a',
+    'start_legs_ac',
+)
+
+quantization_dtypes = ('float64', 'float32', 'uint16', 'uint8')
+
+def game_rules(config):
+    return dict(zip(
+        rule_names,
+        (config.max_head_hits,
+         config.max_body_hits,
+         config.max_legs_hits,
+         config.max_total_hits) + tuple(config.start_cards),
+    ))
+
+def header_config(header):
+    '''
+    Rebuilds the GameConfig a solution was computed for from its header.
+    Files written before payoffs were configurable use the standard payoffs.
+    '''
+    rules = [header['rules'][name] for name in rule_names]
+    return GameConfig(
+        header['game_mode'],
+        *rules[:4],
+        start_cards=tuple(rules[4:]),
+        payoffs=tuple(header.get('payoffs', standard_payoffs)),
+    )
+
+def quantize(x, dtype):
+    if numpy.issubdtype(dtype, numpy.integer):
+        scale = numpy.iinfo(dtype).max
+        return numpy.round(numpy.clip(x, 0., 1.) * scale).astype(dtype)
+    return numpy.asarray(x).astype(dtype)
+
+def dequantize(x, dtype):
+    if numpy.issubdtype(dtype, numpy.integer):
+        return numpy.asarray(x, dtype=numpy.float64) / numpy.iinfo(dtype).max
+    return numpy.asarray(x, dtype=numpy.float64)
+
+def stored_indices(tables, positions, symmetric):
+    if symmetric:
+        return tables.canonical_to_indices(positions)
+    return positions
+
+def policy_widths(tables, num_stored, symmetric, player, chunk_size=2**20):
+    '''
+    Computes the number of legal actions for one player in each stored state.
+    '''
+    widths = numpy.zeros(num_stored, dtype=numpy.int8)
+    for start in range(0, num_stored, chunk_size):
+        end = min(start + chunk_size, num_stored)
+        indices = stored_indices(tables, numpy.arange(start, end), symmetric)
+        widths[start:end] = tables.action_masks(indices)[player].sum(axis=1)
+    return widths
+
+def policy_blocks(widths):
+    '''
+    Run-length encodes the policy widths into block starts, offsets and
+    widths, and returns them with the total number of policy entries.
+    '''
+    starts = numpy.flatnonzero(numpy.diff(widths, prepend=-1))
+    block_widths = widths[starts].astype(numpy.int64)
+    lengths = numpy.diff(numpy.append(starts, len(widths)))
+    offsets = numpy.concatenate(([0], numpy.cumsum(lengths * block_widths)))
+    return (starts, offsets[:-1], block_widths), int(offsets[-1])
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError('%s is not a solution file'%path)
+        header = json.loads(f.read(header_size - len(magic)).decode('utf-8'))
+    if header['format_version'] != format_version:
+        raise ValueError('unsupported solution format version %i'%(
+            header['format_version']))
+    return header
+
+def write_header(path, header):
+    data = json.dumps(header).encode('utf-8')
+    if len(data) > header_size - len(magic):
+        raise ValueError('solution header is too large')
+    with open(path, 'r+b') as f:
+        f.write(magic)
+        f.write(data.ljust(header_size - len(magic), b' '))
+
+def create_solution(path, config=None, symmetric=False, dtype='float64'):
+    '''
+    Creates a solution file with a header and zeroed arrays, and returns the
+    header.  The arrays can then be filled with open_solution_arrays.
+    '''
+    if dtype not in quantization_dtypes:
+        raise ValueError('dtype must be one of %s'%(quantization_dtypes,))
+    if config is None:
+        config = default_config
+    tables = game_tables(config)
+    if symmetric:
+        num_stored = tables.total_canonical_states
+    else:
+        num_stored = tables.total_states
+    arrays = {}
+    offset = header_size
+    def add_array(name, array_dtype, shape):
+        nonlocal offset
+        arrays[name] = {
+            'dtype' : array_dtype,
+            'shape' : list(shape),
+            'offset' : offset,
+        }
+        size = int(numpy.prod(shape)) * numpy.dtype(array_dtype).itemsize
+        offset += -(-size // array_alignment) * array_alignment
+
+    add_array('v', dtype, (num_stored,))
+    blocks = {}
+    players = ('p', 'p2') if symmetric else ('p',)
+    for player, name in enumerate(players):
+        widths = policy_widths(tables, num_stored, symmetric, player)
+        blocks[name], num_entries = policy_blocks(widths)
+        add_array(name, dtype, (num_entries,))
+        for suffix in '_block_starts', '_block_offsets', '_block_widths':
+            add_array(name + suffix, 'int64', (len(blocks[name][0]),))
+
+    header = {
+        'format_version' : format_version,
+        'game_mode' : config.name,
+        'rules' : game_rules(config),
+        'payoffs' : list(config.payoffs),
+        'num_states' : tables.total_states,
+        'num_stored_states' : num_stored,
+        'symmetric' : symmetric,
+        'quantization' : dtype,
+        'max_value_error' : 0.,
+        'max_policy_error' : 0.,
+        'arrays' : arrays,
+    }
+    with open(path, 'wb') as f:
+        f.truncate(offset)
+    write_header(path, header)
+
+    # write the block tables
+    solution_arrays = open_solution_arrays(path, header, mode='r+')
+    for name, (starts, offsets, widths) in blocks.items():
+        solution_arrays[name + '_block_starts'][:] = starts
+        solution_arrays[name + '_block_offsets'][:] = offsets
+        solution_arrays[name + '_block_widths'][:] = widths
+    for array in solution_arrays.values():
+        array.flush()
+
+    return header
+
+def open_solution_arrays(path, header, mode='r'):
+    return {
+        name : numpy.memmap(
+            path,
+            dtype=info['dtype'],
+            mode=mode,
+            offset=info['offset'],
+            shape=tuple(info['shape']),
+        )
+        for name, info in header['arrays'].items()
+    }
+
+def policy_offsets(arrays, name, positions):
+    starts = arrays[name + '_block_starts']
+    b = numpy.searchsorted(starts, positions, side='right') - 1
+    return (
+        arrays[name + '_block_offsets'][b] +
+        (positions - starts[b]) * arrays[name + '_block_widths'][b]
+    )
+
+def write_solution_chunk(
+    arrays,
+    header,
+    positions,
+    value,
+    policy,
+    opponent_policy=None,
+):
+    '''
+    Writes the values and full (N,9) policies of the stored states at an
+    array of positions.  Returns the largest error introduced by quantizing
+    the values and the policies, where the policy error is measured on the
+    renormalized policies that SolutionFile.policy reads back.
+    '''
+    dtype = header['quantization']
+    tables = game_tables(header_config(header))
+    positions = numpy.asarray(positions, dtype=numpy.int64)
+    indices = stored_indices(tables, positions, header['symmetric'])
+    masks = tables.action_masks(indices)
+
+    value = numpy.asarray(value)
+    q = quantize(value, dtype)
+    arrays['v'][positions] = q
+    value_error = float(numpy.max(
+        numpy.abs(dequantize(q, dtype) - value), initial=0.))
+
+    policy_error = 0.
+    players = [('p', policy, masks[0])]
+    if opponent_policy is not None:
+        players.append(('p2', opponent_policy, masks[1]))
+    for name, p, mask in players:
+        offsets = policy_offsets(arrays, name, positions)
+        ranks = numpy.cumsum(mask, axis=1) - 1
+        entries = numpy.asarray(p)[mask]
+        q = quantize(entries, dtype)
+        arrays[name][(offsets[:,None] + ranks)[mask]] = q
+
+        # SolutionFile.policy renormalizes each row after dequantizing it,
+        # so measure the error of the rows it will return
+        read = numpy.zeros(mask.shape)
+        read[mask] = dequantize(q, dtype)
+        read /= read.sum(axis=1, keepdims=True)
+        policy_error = max(policy_error, float(numpy.max(
+            numpy.abs(read[mask] - entries), initial=0.)))
+
+    return value_error, policy_error
+
+def write_solution(
+    path,
+    value,
+    policy,
+    opponent_policy=None,
+    dtype='float64',
+    chunk_size=2**20,
+    config=None,
+):
+    '''
+    Writes a solution file from a value array and an (N,9) policy array for
+    every state.  If opponent_policy is provided, the solution is symmetric
+    and all three arrays should only contain the canonical states.
+    '''
+    symmetric = opponent_policy is not None
+    header = create_solution(
+        path, config=config, symmetric=symmetric, dtype=dtype)
+    arrays = open_solution_arrays(path, header, mode='r+')
+    for start in range(0, header['num_stored_states'], chunk_size):
+        end = min(start + chunk_size, header['num_stored_states'])
+        value_error, policy_error = write_solution_chunk(
+            arrays,
+            header,
+            numpy.arange(start, end),
+            value[start:end],
+            policy[start:end],
+            None if opponent_policy is None else opponent_policy[start:end],
+        )
+        header['max_value_error'] = max(
+            header['max_value_error'], value_error)
+        header['max_policy_error'] = max(
+            header['max_policy_error'], policy_error)
+    for array in arrays.values():
+        array.flush()
+    write_header(path, header)
+    return header
+
+class SolutionValues:
+    '''
+    Presents the values stored in a solution as an array over every state
+    index, so that it can be passed anywhere a value array is expected.
+    '''
+    def __init__(self, solution):
+        self.solution = solution
+
+    def __len__(self):
+        return self.solution.tables.total_states
+
+    def __getitem__(self, indices):
+        return self.solution.value(indices)
+
+class SolutionFile:
+    '''
+    A memory mapped solution file.  Nothing but the header is read until a
+    state is looked up, and the arrays are not even opened until then.  If
+    config is given, the file must have been solved for the same rules,
+    otherwise the configuration is read from the header.  arrays can be
+    given to use arrays that have already been loaded, such as the views of
+    a shared_solution.SharedSolution, instead of memory mapping the file.
+    '''
+    def __init__(self, path, config=None, arrays=None):
+        self.path = path
+        self.header = read_header(path)
+        if config is None:
+            config = header_config(self.header)
+        elif header_config(self.header)[1:] != config[1:]:
+            raise ValueError(
+                '%s was solved for different game rules (%s)'%(
+                path, self.header['game_mode']))
+        self.config = config
+        self.tables = game_tables(config)
+        self.symmetric = self.header['symmetric']
+        self.dtype = numpy.dtype(self.header['quantization'])
+        self.mapped_arrays = arrays
+        self.values = SolutionValues(self)
+    
+    @property
+    def arrays(self):
+        if self.mapped_arrays is None:
+            self.mapped_arrays = open_solution_arrays(self.path, self.header)
+        return self.mapped_arrays
+
+    def positions(self, indices):
+        indices = numpy.asarray(indices, dtype=numpy.int64).reshape(-1)
+        if self.symmetric:
+            return self.tables.canonical_indices(indices)
+        if numpy.any(indices < 0) or numpy.any(
+            indices >= self.tables.total_states):
+            raise IndexError('index too large')
+        return indices, numpy.zeros(indices.shape, dtype=bool)
+
+    def value(self, indices):
+        positions, mirrored = self.positions(indices)
+        v = dequantize(self.arrays['v'][positions], self.dtype)
+        v = numpy.where(mirrored, 1. - v, v)
+        if numpy.ndim(indices):
+            return v.reshape(numpy.shape(indices))
+        return v[0]
+
+    def policy(self, indices):
+        '''
+        Returns the policy of p1 over all nine actions in each state.
+        '''
+        positions, mirrored = self.positions(indices)
+        masks, _ = self.tables.action_masks(numpy.asarray(indices).reshape(-1))
+        policy = numpy.zeros(masks.shape)
+        for name, rows in ('p', ~mirrored), ('p2', mirrored):
+            if not numpy.any(rows):
+                continue
+            offsets = policy_offsets(self.arrays, name, positions[rows])
+            ranks = numpy.cumsum(masks[rows], axis=1) - 1
+            entries = (offsets[:,None] + ranks)[masks[rows]]
+            p = numpy.zeros((len(offsets), 9))
+            p[masks[rows]] = dequantize(self.arrays[name][entries], self.dtype)
+            policy[rows] = p
+        policy /= policy.sum(axis=1, keepdims=True)
+        if numpy.ndim(indices):
+            return policy.reshape(numpy.shape(indices) + (9,))
+        return policy[0]
+
+class PickledSolution:
+    '''
+    A solution stored in the original pickle format, with the same interface
+    as SolutionFile.  Pickles do not record the rules they were solved for, so
+    they are assumed to match config.  If data is given, it is used instead
+    of loading the pickle again.
+    '''
+    def __init__(self, path, config=None, data=None):
+        self.path = path
+        if data is None:
+            with open(path, 'rb') as f:
+                data = pickle.load(f)
+        self.data = data
+        if config is None:
+            config = default_config
+        self.config = config
+        self.tables = game_tables(config)
+
+        # symmetric solutions only store the canonical state of each mirrored
+        # pair, along with the policy of both players
+        self.symmetric = self.data.get('symmetric', False)
+        if self.symmetric:
+            self.values = MirroredValues(self.data['v'], self.tables)
+        else:
+            self.values = self.data['v']
+
+    def value(self, indices):
+        return self.values[indices]
+
+    def policy(self, indices):
+        if not self.symmetric:
+            return self.data['p'][indices]
+        canonical, mirrored = self.tables.canonical_indices(indices)
+        policy = numpy.where(
+            mirrored[:,None],
+            self.data['p2'][canonical],
+            self.data['p'][canonical],
+        )
+        if numpy.ndim(indices):
+            return policy.reshape(numpy.shape(indices) + (9,))
+        return policy[0]
+
+def is_solution_file(path):
+    with open(path, 'rb') as f:
+        return f.read(len(magic)) == magic
+
+def load_solution(path, config=None):
+    if is_solution_file(path):
+        return SolutionFile(path, config=config)
+    else:
+        return PickledSolution(path, config=config)
+
+def convert_solution(pickle_path, path, dtype='float64', config=None):
+    '''
+    Converts a solution from the original pickle format.
+    '''
+    with open(pickle_path, 'rb') as f:
+        data = pickle.load(f)
+    return write_solution(
+        path,
+        data['v'],
+        data['p'],
+        data.get('p2'),
+        dtype=dtype,
+        config=config,
+    )
+
+parser = argparse.ArgumentParser()
+parser.add_argument('pickle_path', type=str)
+parser.add_argument('--output', type=str, default=None)
+parser.add_argument(
+    '--dtype', type=str, default='float64', choices=quantization_dtypes)
+parser.add_argument(
+    '--mode', type=str, default=game_mode, choices=tuple(game_configs),
+    help='The game configuration the pickled solution was solved for.')
+
+def convert_solution_commandline():
+    args = parser.parse_args()
+    output = args.output
+    if output is None:
+        output = os.path.splitext(args.pickle_path)[0] + '.b4s'
+    header = convert_solution(
+        args.pickle_path,
+        output,
+        dtype=args.dtype,
+        config=game_configs[args.mode],
+    )
+    print('Wrote %s (max value error %g, max policy error %g)'%(
+        output, header['max_value_error'], header['max_policy_error']))
@@ -1,8 +1,8 @@
 import time
 import os
 import sys
+import shutil
 import multiprocessing
-import pickle
 import json
 from zipfile import ZipFile
 from argparse import ArgumentParser
@@ -14,14 +14,23 @@ from scipy.optimize import OptimizeWarning
 
 import tqdm
 
-from black_belt.bodega_brawl import game_mode, State
-from black_belt.ne import lp_solve_zero_sum
-from black_belt.game_statistics import (
-    total_states,
-    state_to_index,
-    index_to_state,
-    payoff_matrix,
+from black_belt.bodega_brawl import game_mode, game_configs, default_config
+from black_belt.ne import lp_solve_zero_sum, batch_lp_solve_zero_sum
+from black_belt.solution_file import (
+    quantization_dtypes,
+    create_solution,
+    read_header,
+    write_header,
+    open_solution_arrays,
+    write_solution_chunk,
 )
+from black_belt.solution_cache import (
+    SolutionCache,
+    make_entries,
+    split_entries,
+)
+from black_belt.game_statistics import game_tables, load_successor_table
+from black_belt.solve_stats import SolveStats, write_report
 
 '''
 Solves the Bodega Brawl game by computing the Nash Equilibrium for every
@@ -29,76 +38,390 @@ possible game state.  This is accomplished by starting from the end of the
 game and working backwards.  This is designed to be run on many processes
 in parallel, and takes approximatesly 30 minutes to solve the large version
 of the game with 40 parallel processes.
+
+Every run writes a json report of where the time went in each worker and
+each card-count layer to solutions/<mode>_solve_report.json (see
+solve_stats.py), even if it fails.
 '''
 
 # setup argument parser
 parser = ArgumentParser()
+parser.add_argument(
+    '--mode', type=str, default=game_mode, choices=tuple(game_configs),
+    help='The game configuration to solve.')
 parser.add_argument('--num-procs', type=int, default=40)
+parser.add_argument(
+    '--successor-table', action='store_true',
+    help='Build payoff matrices from a precomputed successor table, building '
+    'the table first if it does not exist yet.')
+parser.add_argument(
+    '--symmetric', action='store_true',
+    help='Only solve one state from each mirrored pair of states.')
+parser.add_argument(
+    '--cache-size', type=int, default=2**18,
+    help='Number of entries in the shared cache of payoff matrix solutions, '
+    'or 0 to disable the cache.')
+parser.add_argument(
+    '--dtype', type=str, default='float64', choices=quantization_dtypes,
+    help='Storage type for the values and policies in the solution file.  '
+    'The integer types store fixed-point probabilities.')
+parser.add_argument(
+    '--resume', action='store_true',
+    help='Resume a solve that was interrupted, skipping finished layers and '
+    'states.')
+parser.add_argument(
+    '--report', type=str, default=None,
+    help='Where to write the json report of the run.  Defaults to '
+    'solutions/<mode>_solve_report.json.')
+parser.add_argument(
+    '--live-stats', action='store_true',
+    help='Show where the workers are spending their time next to the '
+    'progress bar.')
+
+# The solver writes its results directly into a solution file in a work
+# directory as it goes, and marks each card-count layer as done once every
+# state in it has been solved and flushed to disk.  Policies are written in
+# the solution file's layout, which only stores the legal actions of each
+# state.  Alongside the solution there is a byte per solved state that marks
+# it complete, and (unless the solution file's value array can be used
+# directly) a value array for every state that payoff matrices are gathered
+# from.  The work value array is float32 unless the solution is float64.  If
+# a run fails, it can be restarted with resume=True to pick up where it left
+# off, and once every layer is done the solution file is finalized in place.
+def open_work(work_path, config, symmetric, dtype, resume):
+    settings = {
+        'game_mode' : config.name,
+        'symmetric' : symmetric,
+        'dtype' : dtype,
+    }
+    settings_path = os.path.join(work_path, 'settings.json')
+    solution_path = os.path.join(work_path, 'solution.b4s')
+    if resume and os.path.exists(settings_path):
+        with open(settings_path) as f:
+            if json.load(f) != settings:
+                raise ValueError(
+                    'cannot resume %s with different settings'%work_path)
+        mode = 'r+'
+    else:
+        if os.path.exists(work_path):
+            shutil.rmtree(work_path)
+        os.makedirs(work_path)
+        create_solution(
+            solution_path, config=config, symmetric=symmetric, dtype=dtype)
+        mode = 'w+'
+    
+    header = read_header(solution_path)
+    solution_arrays = open_solution_arrays(solution_path, header, mode='r+')
+    work = {
+        'complete' : numpy.lib.format.open_memmap(
+            os.path.join(work_path, 'complete.npy'),
+            mode=mode,
+            dtype=numpy.uint8,
+            shape=(header['num_stored_states'],),
+        )
+    }
+    if not symmetric and dtype in ('float64', 'float32'):
+        work['value'] = solution_arrays['v']
+    else:
+        work['value'] = numpy.lib.format.open_memmap(
+            os.path.join(work_path, 'value.npy'),
+            mode=mode,
+            dtype=numpy.float64 if dtype == 'float64' else numpy.float32,
+            shape=(header['num_states'],),
+        )
+    
+    if mode == 'w+':
+        with open(settings_path, 'w') as f:
+            json.dump(settings, f)
+    return solution_path, header, solution_arrays, work
+
+def layer_marker_path(work_path, num_cards):
+    return os.path.join(work_path, 'layer_%02i.done'%num_cards)
 
-def solve(num_procs=40):
+def mark_layer_done(work_path, arrays, num_cards, errors):
+    '''
+    Flushes the work arrays and durably marks a layer as done.  The marker
+    records the largest quantization errors seen so far so that they survive
+    a resume.
+    '''
+    for array in arrays:
+        array.flush()
+    with open(layer_marker_path(work_path, num_cards), 'w') as f:
+        json.dump(errors, f)
+        f.flush()
+        os.fsync(f.fileno())
 
+def solve(
+    config=None,
+    num_procs=40,
+    successor_table=False,
+    symmetric=False,
+    cache_size=2**18,
+    dtype='float64',
+    resume=False,
+    chunk_size=2048,
+    report_path=None,
+    live_stats=False,
+):
+    
+    if config is None:
+        config = default_config
+    if symmetric and not config.symmetric:
+        raise ValueError(
+            'the %s game does not have symmetric payoffs'%config.name)
+    tables = game_tables(config)
+    
+    # load or build the successor table
+    if not os.path.exists('./solutions'):
+        os.makedirs('./solutions')
+    successors = None
+    if successor_table:
+        successor_path = './solutions/%s_successors.npy'%config.name
+        if not os.path.exists(successor_path):
+            tables.build_successor_table(successor_path)
+        successors = load_successor_table(successor_path)
+
+    # In symmetric mode only the canonical state of each mirrored pair is
+    # solved.  The value of every state is still stored so that payoff
+    # matrices can be built with a single gather, but the policies of both
+    # players are only stored for the canonical states.
+    if symmetric:
+        num_solved_states = tables.total_canonical_states
+        layer_starts = tables.canonical_count_starts
+    else:
+        num_solved_states = tables.total_states
+        layer_starts = tables.card_count_starts
+    
+    # open the work arrays and find out what was finished in a previous run
+    work_path = './solutions/%s_work'%config.name
+    solution_path, header, solution_arrays, work = open_work(
+        work_path, config, symmetric, dtype, resume)
+    value = work['value']
+    complete = work['complete']
+    flush_arrays = list(solution_arrays.values()) + list(work.values())
+    finished_layers = {}
+    for num_cards in range(1, tables.total_starting_cards+1):
+        marker_path = layer_marker_path(work_path, num_cards)
+        if os.path.exists(marker_path):
+            with open(marker_path) as f:
+                finished_layers[num_cards] = json.load(f)
+    initial_complete = int(numpy.count_nonzero(complete))
+    
     # setup multiprocessing and shared data
+    start_time = time.time()
     context = multiprocessing.get_context(None)
-    policy_shape = (9, total_states)
-    policy = context.RawArray('d', policy_shape[0]*policy_shape[1])
-    value = context.RawArray('d', total_states)
-    complete = context.RawArray('d', total_states)
+    solved = context.RawArray('q', num_procs)
     status = context.RawArray('d', num_procs)
-
+    
+    # the largest value and policy quantization errors seen by each worker
+    errors = context.RawArray('d', num_procs*2)
+    for layer_errors in finished_layers.values():
+        errors[0] = max(errors[0], layer_errors['max_value_error'])
+        errors[1] = max(errors[1], layer_errors['max_policy_error'])
+    
+    # Identical payoff matrices are only solved once.  Duplicates within a
+    # chunk are removed before solving, and solutions are shared between
+    # chunks and workers through the cache.
+    cache = None
+    if cache_size:
+        cache = SolutionCache(cache_size, context)
+    
+    # each worker records its work and timings in each layer
+    stats = SolveStats(num_procs, tables.total_starting_cards, context)
+    
+    # States only ever transition to states with one fewer card, so each
+    # card-count layer only depends on the layers before it.  The workers
+    # solve one layer at a time, claiming chunks of states from a shared
+    # counter, and wait at a barrier before moving on to the next layer.
+    next_chunk = context.RawArray('q', tables.total_starting_cards+1)
+    chunk_lock = context.Lock()
+    barrier = context.Barrier(num_procs)
+    
     # zero the shared data
-    complete_np = numpy.frombuffer(complete, dtype=numpy.float64)
-    numpy.copyto(complete_np, numpy.zeros(total_states))
+    solved_np = numpy.frombuffer(solved, dtype=numpy.int64)
+    numpy.copyto(solved_np, numpy.zeros(num_procs, dtype=numpy.int64))
     status_np = numpy.frombuffer(status, dtype=numpy.float64)
     numpy.copyto(status_np, numpy.zeros(num_procs))
     
+    def max_errors():
+        errors_np = numpy.frombuffer(errors, dtype=numpy.float64)
+        return {
+            'max_value_error' : float(errors_np[0::2].max()),
+            'max_policy_error' : float(errors_np[1::2].max()),
+        }
+    
+    # solves a single state with linprog and returns the policy of each
+    # player over all nine actions along with the value
+    def solve_state(i, proc_id):
+        state = tables.index_to_state(i)
+        game, p1_actions = tables.payoff_matrix(
+            state, value, successors=successors)
+        _, p2_actions = state.action_space
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', OptimizeWarning)
+            try:
+                p, v = lp_solve_zero_sum(game)
+                if symmetric:
+                    q, _ = lp_solve_zero_sum(1. - game.T)
+                else:
+                    q = numpy.zeros(len(p2_actions))
+            except:
+                failure_log = {
+                    'index' : i,
+                    'state' : state,
+                    'game' : game.tolist(),
+                    'error' : 'solve_error',
+                }
+                with open('./fail_log_%i.json'%proc_id, 'w') as f:
+                    json.dump(failure_log, f, indent=2)
+                raise
+        
+        if numpy.any(numpy.isnan(v)) or numpy.any(numpy.isnan(p)):
+            failure_log = {
+                'index' : i,
+                'state' : state,
+                'game' : game.tolist(),
+                'v' : v,
+                'p' : p.tolist(),
+                'error' : 'value_error',
+            }
+            with open('./fail_log_%i.json'%proc_id, 'w') as f:
+                json.dump(failure_log, f, indent=2)
+            raise Exception('nan value')
+        
+        full_p = numpy.zeros(9)
+        full_p[[int(a) for a in p1_actions]] = p
+        full_q = numpy.zeros(9)
+        full_q[[int(a) for a in p2_actions]] = q
+        return full_p, v, full_q
+    
+    # solves a chunk of states with the batched solver, falling back to
+    # solve_state for any that the batched solver could not handle
+    def solve_chunk(chunk_start, chunk_end, proc_id, worker_stats):
+        start = time.perf_counter()
+        worker_stats.count('chunks')
+        positions = numpy.arange(chunk_start, chunk_end)
+        positions = positions[complete[positions] == 0]
+        if not len(positions):
+            return 0
+        if symmetric:
+            indices = tables.canonical_to_indices(positions)
+        else:
+            indices = positions
+        games = tables.payoff_matrices(indices, value, successors)
+        if value.dtype != numpy.float64:
+            # round the terminal payoffs the same way as the stored values,
+            # or payoffs that should tie differ by round-off and the batched
+            # solver loses precision and falls back on linprog
+            games = games.astype(value.dtype).astype(numpy.float64)
+        built = time.perf_counter()
+        worker_stats.add_time('build_seconds', built - start)
+        
+        # find the games that need to be solved
+        if cache is not None:
+            keys = cache.make_keys(games)
+            keys, unique, inverse = numpy.unique(
+                keys, axis=0, return_index=True, return_inverse=True)
+            found, entries = cache.lookup(keys)
+            unsolved = unique[~found]
+        else:
+            unsolved = numpy.arange(len(indices))
+        looked_up = time.perf_counter()
+        worker_stats.add_time('cache_seconds', looked_up - built)
+        
+        # solve them
+        illegal = numpy.isnan(games[unsolved])
+        row_mask = ~illegal.all(axis=2)
+        col_mask = ~illegal.all(axis=1)
+        p, v, q, success = batch_lp_solve_zero_sum(
+            games[unsolved], row_mask=row_mask, col_mask=col_mask)
+        worker_stats.lp_time(time.perf_counter() - looked_up, n=len(unsolved))
+        worker_stats.matrix_sizes(col_mask.sum(axis=1), row_mask.sum(axis=1))
+        for k in numpy.flatnonzero(~success):
+            fallback_start = time.perf_counter()
+            p[k], v[k], q[k] = solve_state(
+                int(indices[unsolved[k]]), proc_id)
+            worker_stats.lp_time(
+                time.perf_counter() - fallback_start, fallback=True)
+        solved_time = time.perf_counter()
+        
+        # share the new solutions and expand them back out to the chunk
+        if cache is not None:
+            entries[~found] = make_entries(p, v, q)
+            cache.insert(keys[~found], entries[~found])
+            p, v, q = split_entries(entries[inverse.reshape(-1)])
+            worker_stats.count('cache_lookups', len(keys))
+            worker_stats.count('cache_hits', int(found.sum()))
+        worker_stats.count('matrices', len(indices))
+        worker_stats.count('lp_solves', len(unsolved))
+        worker_stats.count('fallback_solves', int((~success).sum()))
+        
+        if symmetric:
+            # mirror-equal states are symmetric games, so their value is
+            # exactly 0.5 and p1's policy is also an equilibrium for p2
+            mirrors = tables.mirror_indices(indices)
+            diagonal = mirrors == indices
+            v[diagonal] = 0.5
+            q[diagonal] = p[diagonal]
+            value[mirrors] = 1. - v
+        else:
+            q = None
+        value[indices] = v
+        value_error, policy_error = write_solution_chunk(
+            solution_arrays, header, positions, v, p, q)
+        errors[proc_id*2] = max(errors[proc_id*2], value_error)
+        errors[proc_id*2+1] = max(errors[proc_id*2+1], policy_error)
+        complete[positions] = 1
+        worker_stats.count('states', len(positions))
+        worker_stats.add_time(
+            'write_seconds', time.perf_counter() - solved_time)
+        return len(positions)
+    
     # worker function that will be launched in each new process
     def worker(proc_id):
+        worker_stats = stats.worker(proc_id)
         try:
-            for i in range(proc_id, total_states, num_procs):
-                if complete[i]:
+            for num_cards in range(1, tables.total_starting_cards+1):
+                if num_cards in finished_layers:
                     continue
-                game, p1_actions = payoff_matrix(
-                    index_to_state(i), value, complete=complete)
-                with warnings.catch_warnings():
-                    warnings.simplefilter('error', OptimizeWarning)
-                    try:
-                        p, v = lp_solve_zero_sum(game)
-                        state = index_to_state(i)
-                    except:
-                        failure_log = {
-                            'index' : i,
-                            'state' : index_to_state(i),
-                            'game' : game.tolist(),
-                            'error' : 'solve_error',
-                        }
-                        with open('./fail_log_%i.json'%proc_id, 'w') as f:
-                            json.dump(failure_log, f, indent=2)
-                            raise
+                worker_stats.set_layer(num_cards)
+                layer_start = time.perf_counter()
+                range_start = layer_starts[num_cards]
+                range_end = layer_starts[num_cards+1]
+                while True:
+                    wait_start = time.perf_counter()
+                    with chunk_lock:
+                        chunk = next_chunk[num_cards]
+                        next_chunk[num_cards] += 1
+                    worker_stats.add_time(
+                        'chunk_wait_seconds', time.perf_counter() - wait_start)
+                    chunk_start = range_start + chunk * chunk_size
+                    if chunk_start >= range_end:
+                        break
+                    chunk_end = min(chunk_start + chunk_size, range_end)
+                    solved[proc_id] += solve_chunk(
+                        chunk_start, chunk_end, proc_id, worker_stats)
                 
-                if numpy.any(numpy.isnan(v)) or numpy.any(numpy.isnan(p)):
-                    failure_log = {
-                        'index' : i,
-                        'state' : index_to_state(i),
-                        'game' : game.tolist(),
-                        'v' : v,
-                        'p' : p,
-                        'error' : 'value_error',
-                    }
-                    with open('./fail_log_%i.json'%proc_id, 'w') as f:
-                        json.dump(failure_log, f, indent=2)
-                        raise Exception('nan value')
-                        
-                value[i] = v
-                full_p = numpy.zeros(9)
-                action_indices = [int(a) for a in p1_actions]
-                full_p[action_indices] = p
-                policy[i*9:(i+1)*9] = full_p
-                complete[i] = 1
+                # wait for the other workers to finish the layer
+                wait_start = time.perf_counter()
+                leader = barrier.wait() == 0
+                done = time.perf_counter()
+                worker_stats.add_time('layer_wait_seconds', done - wait_start)
+                if leader:
+                    mark_layer_done(
+                        work_path, flush_arrays, num_cards, max_errors())
+                    worker_stats.add_time(
+                        'write_seconds', time.perf_counter() - done)
+                worker_stats.add_time(
+                    'total_seconds', time.perf_counter() - layer_start)
         except:
+            worker_stats.count('failures')
             status[proc_id] = 1
+            barrier.abort()
             raise
     
     # make new processes
+    processes = []
     for i in range(num_procs):
         process = context.Process(
             target=worker,
@@ -107,35 +430,95 @@ def solve(num_procs=40):
         )
         process.daemon = True
         process.start()
+        processes.append(process)
+    
+    # the report is written at the end of the run, whether it failed or not
+    if report_path is None:
+        report_path = './solutions/%s_solve_report.json'%config.name
+    def save_report(result):
+        report = stats.report(
+            game_mode=config.name,
+            result=result,
+            num_procs=num_procs,
+            symmetric=symmetric,
+            successor_table=successor_table,
+            cache_size=cache_size,
+            chunk_size=chunk_size,
+            dtype=dtype,
+            resume=resume,
+            wall_seconds=time.time() - start_time,
+            **max_errors(),
+        )
+        write_report(report_path, report)
+        return report
     
     # keep track of progress
-    progress = tqdm.tqdm(total=total_states)
+    progress = tqdm.tqdm(total=num_solved_states)
     last_complete = 0
     total_complete = 0
-    while total_complete < total_states:
-        total_complete = complete_np.sum()
+    last_summary = 0.
+    while total_complete < num_solved_states:
+        total_complete = initial_complete + solved_np.sum()
         progress.update(int(total_complete - last_complete))
         last_complete = total_complete
-        if status_np.sum():
-            indices = numpy.where(status_np)
+        if live_stats and time.time() - last_summary >= 1.:
+            progress.set_postfix_str(stats.summary())
+            last_summary = time.time()
+        failed = [
+            i for i, process in enumerate(processes)
+            if status_np[i] or process.exitcode not in (None, 0)
+        ]
+        if failed:
+            progress.close()
+            save_report('failed')
             raise Exception(
-                'workers ' + ','.join(str(i) for i in indices) + ' failed')
+                'workers ' + ','.join(str(i) for i in failed) + ' failed, '
+                'run again with --resume to continue')
         time.sleep(0.1)
     
-    # save the policy and value
-    np_policy = numpy.frombuffer(policy, dtype=numpy.float64).reshape(-1, 9)
-    np_value = numpy.frombuffer(value, dtype=numpy.float64)
-    if not os.path.exists('./solutions'):
-        os.makedirs('./solutions')
-    with open('./solutions/%s_final.pkl'%game_mode, 'wb') as f:
-        pickle.dump({'p':np_policy, 'v':np_value}, f)
+    progress.close()
+    for process in processes:
+        process.join()
+    
+    # summarize the work saved by deduplicating payoff matrices
+    total = save_report('complete')['total']
+    print('Solved %i payoff matrices with %i LP solves (%i avoided)'%(
+        total['matrices'],
+        total['lp_solves'],
+        total['matrices'] - total['lp_solves'],
+    ))
+    if cache is not None:
+        print('Cache hit rate: %.02f%% (%i/%i)'%(
+            100. * total['cache_hits'] / max(total['cache_lookups'], 1),
+            total['cache_hits'],
+            total['cache_lookups'],
+        ))
+    print('%s, report saved to %s'%(stats.summary(), report_path))
+    
+    # finalize the solution file in place
+    for array in flush_arrays:
+        array.flush()
+    header.update(max_errors())
+    write_header(solution_path, header)
+    os.replace(solution_path, './solutions/%s_final.b4s'%config.name)
+    shutil.rmtree(work_path)
     
 def solve_commandline():
     
     # parse the arguments
     args = parser.parse_args()
     
-    solve(num_procs=args.num_procs)
+    solve(
+        config=game_configs[args.mode],
+        num_procs=args.num_procs,
+        successor_table=args.successor_table,
+        symmetric=args.symmetric,
+        cache_size=args.cache_size,
+        dtype=args.dtype,
+        resume=args.resume,
+        report_path=args.report,
+        live_stats=args.live_stats,
+    )
 
 if __name__ == '__main__':
     solve_commandline()
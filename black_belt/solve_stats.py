@@ -0,0 +1,227 @@
+import math
+import json
+
+import numpy
+
+'''
+Instrumentation for the solver.  Every worker records what it does in each
+card-count layer: how many states, chunks and payoff matrices it handled, how
+the cache did, how long it spent building payoff matrices, solving linear
+programs, writing results and waiting on other workers, histograms of how
+long each linear program took, the sizes of the matrices it solved and how
+many times the batched solver failed and had to fall back on linprog.  The
+batched solver only times whole chunks, so the linear programs in a chunk
+are each counted in the histogram with their share of the chunk's time.
+
+The statistics live in shared memory allocated before the workers are forked,
+and each worker only writes to its own rows, so no locks are needed.  They
+are only updated once per chunk (or per fallback solve), which costs a few
+calls to time.perf_counter for every couple of thousand states, so they can
+be left on for every solve.  At the end of a run they are written to a json
+report, and summary can be called at any time for a live view.
+'''
+
+# per worker and per layer counters
+count_names = (
+    'states',
+    'chunks',
+    'matrices',
+    'cache_lookups',
+    'cache_hits',
+    'lp_solves',
+    'fallback_solves',
+    'failures',
+)
+count_columns = {name : i for i, name in enumerate(count_names)}
+
+# per worker and per layer timers in seconds
+time_names = (
+    'build_seconds',
+    'cache_seconds',
+    'lp_seconds',
+    'fallback_seconds',
+    'write_seconds',
+    'chunk_wait_seconds',
+    'layer_wait_seconds',
+    'total_seconds',
+)
+time_columns = {name : i for i, name in enumerate(time_names)}
+
+# Linear program times are binned by powers of two, from 2**-20 seconds (about
+# a microsecond) up to 2**6 seconds.  The first and last bins also count
+# everything below and above them.
+histogram_min_exponent = -20
+histogram_bins = 27
+histogram_names = ('lp_histogram', 'fallback_histogram')
+
+def histogram_bin(seconds):
+    if seconds <= 0.:
+        return 0
+    return min(max(
+        math.floor(math.log2(seconds)) - histogram_min_exponent, 0),
+        histogram_bins - 1)
+
+def histogram_edges():
+    return [2.**(histogram_min_exponent + i) for i in range(histogram_bins)]
+
+class SolveStats:
+    def __init__(self, num_procs, num_layers, context):
+        self.num_procs = num_procs
+        self.num_layers = num_layers
+        shape = num_procs * num_layers
+        self.counts = context.RawArray('q', shape * len(count_names))
+        self.times = context.RawArray('d', shape * len(time_names))
+        self.histograms = context.RawArray(
+            'q', shape * len(histogram_names) * histogram_bins)
+
+        # the number of legal actions of each player in the solved matrices
+        self.sizes = context.RawArray('q', shape * 81)
+
+    def arrays(self):
+        '''
+        Returns numpy views of the counters (P,L,8), timers (P,L,8), linear
+        program histograms (P,L,2,27) and matrix sizes (P,L,9,9), where P is
+        the number of workers and L is the number of layers.  Layer n is
+        stored at n-1, and sizes[...,r-1,c-1] counts the matrices with r
+        legal actions for p1 and c for p2.
+        '''
+        p, l = self.num_procs, self.num_layers
+        counts = numpy.frombuffer(self.counts, dtype=numpy.int64).reshape(
+            p, l, len(count_names))
+        times = numpy.frombuffer(self.times, dtype=numpy.float64).reshape(
+            p, l, len(time_names))
+        histograms = numpy.frombuffer(
+            self.histograms, dtype=numpy.int64).reshape(
+            p, l, len(histogram_names), histogram_bins)
+        sizes = numpy.frombuffer(self.sizes, dtype=numpy.int64).reshape(
+            p, l, 9, 9)
+        return counts, times, histograms, sizes
+
+    def worker(self, proc_id):
+        return WorkerStats(self, proc_id)
+
+    def report(self, **info):
+        '''
+        Builds a json-compatible report with the totals of each layer, each
+        worker and each worker in each layer, along with any extra info.
+        '''
+        counts, times, histograms, sizes = self.arrays()
+        def summarize(c, t, h, s):
+            summary = {name : int(c[i]) for i, name in enumerate(count_names)}
+            summary.update(
+                {name : float(t[i]) for i, name in enumerate(time_names)})
+            for i, name in enumerate(histogram_names):
+                summary[name] = h[i].tolist()
+            summary['matrix_sizes'] = {
+                '%ix%i'%(r+1, c+1) : int(s[r,c])
+                for r, c in zip(*numpy.nonzero(s))
+            }
+            summary['states_per_second'] = (
+                summary['states'] / max(summary['total_seconds'], 1e-9))
+            return summary
+
+        layers = {}
+        for l in range(self.num_layers):
+            if counts[:,l].any() or times[:,l].any():
+                layers[l+1] = summarize(
+                    counts[:,l].sum(axis=0),
+                    times[:,l].sum(axis=0),
+                    histograms[:,l].sum(axis=0),
+                    sizes[:,l].sum(axis=0),
+                )
+        workers = []
+        for p in range(self.num_procs):
+            worker = summarize(
+                counts[p].sum(axis=0),
+                times[p].sum(axis=0),
+                histograms[p].sum(axis=0),
+                sizes[p].sum(axis=0),
+            )
+            worker['layers'] = {
+                l+1 : summarize(
+                    counts[p,l], times[p,l], histograms[p,l], sizes[p,l])
+                for l in range(self.num_layers)
+                if counts[p,l].any() or times[p,l].any()
+            }
+            workers.append(worker)
+
+        report = dict(info)
+        report['histogram_edges'] = histogram_edges()
+        report['total'] = summarize(
+            counts.sum(axis=(0,1)),
+            times.sum(axis=(0,1)),
+            histograms.sum(axis=(0,1)),
+            sizes.sum(axis=(0,1)),
+        )
+        report['layers'] = layers
+        report['workers'] = workers
+        return report
+
+    def summary(self):
+        '''
+        A one line summary of where the workers have spent their time so far.
+        '''
+        counts, times, _, _ = self.arrays()
+        c = counts.sum(axis=(0,1))
+        t = times.sum(axis=(0,1))
+        # total_seconds is only added at the end of each layer, so the
+        # percentages are of the time accounted for so far
+        total = max(t[:time_columns['total_seconds']].sum(), 1e-9)
+        def percent(name):
+            return 100. * t[time_columns[name]] / total
+        return ('build %.0f%%, cache %.0f%%, lp %.0f%%, fallback %.0f%%, '
+            'write %.0f%%, wait %.0f%%, %i lp solves, %i fallbacks, '
+            '%i failures'%(
+            percent('build_seconds'),
+            percent('cache_seconds'),
+            percent('lp_seconds'),
+            percent('fallback_seconds'),
+            percent('write_seconds'),
+            percent('chunk_wait_seconds') + percent('layer_wait_seconds'),
+            c[count_columns['lp_solves']],
+            c[count_columns['fallback_solves']],
+            c[count_columns['failures']],
+        ))
+
+def write_report(path, report):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+class WorkerStats:
+    '''
+    The rows of SolveStats that belong to one worker.  Call set_layer before
+    recording anything in a new layer.
+    '''
+    def __init__(self, stats, proc_id):
+        self.counts, self.times, self.histograms, self.sizes = (
+            a[proc_id] for a in stats.arrays())
+        self.layer = 0
+
+    def set_layer(self, num_cards):
+        self.layer = num_cards - 1
+
+    def count(self, name, n=1):
+        self.counts[self.layer, count_columns[name]] += n
+
+    def add_time(self, name, seconds):
+        self.times[self.layer, time_columns[name]] += seconds
+
+    def lp_time(self, seconds, fallback=False, n=1):
+        '''
+        Records seconds spent solving n linear programs together.  The batched
+        solver does not time each one, so the histogram counts n programs
+        that each took seconds / n.
+        '''
+        self.add_time(
+            'fallback_seconds' if fallback else 'lp_seconds', seconds)
+        if n:
+            self.histograms[
+                self.layer, int(fallback), histogram_bin(seconds / n)] += n
+
+    def matrix_sizes(self, rows, cols):
+        '''
+        Counts the matrices with rows[i] legal actions for p1 and cols[i]
+        for p2.
+        '''
+        self.sizes[self.layer] += numpy.bincount(
+            (rows - 1) * 9 + (cols - 1), minlength=81).reshape(9, 9)
@@ -1,82 +1,191 @@
-import random
-import pickle
 import argparse
 
-import tqdm
+import numpy
 
-from black_belt.bodega_brawl import State, game_mode
-from black_belt.game_statistics import payoff_matrix
+from black_belt.bodega_brawl import game_mode, game_configs, default_config
+from black_belt.game_statistics import load_successor_table
 from black_belt.agent import (
     SolvedAgent,
     RandomAgent,
     BestResponseAgent,
     ArgmaxCounterAgent,
     MCTSAgent,
+    PolicyServerAgent,
+    evaluate,
 )
-from black_belt.ne import best_response
+from black_belt.best_response import best_response_path
+from black_belt.mcts import make_evaluator
+from black_belt.simulate import simulate
+
+opponents = ('random', 'best_response', 'argmax_counter', 'solved', 'mcts')
 
 parser = argparse.ArgumentParser()
-parser.add_argument('--opponent', type=str, default='random')
+parser.add_argument(
+    '--mode', type=str, default=game_mode, choices=tuple(game_configs),
+    help='The game configuration to test.')
+parser.add_argument(
+    '--opponent', type=str, default='random', choices=opponents)
 parser.add_argument('--games', type=int, default=10000)
 parser.add_argument('--mcts-samples', type=int, default=10000)
+parser.add_argument(
+    '--mcts-procs', type=int, default=1,
+    help='Search each of the mcts opponent\'s moves in this many processes.')
+parser.add_argument(
+    '--mcts-seconds', type=float, default=None,
+    help='Search each of the mcts opponent\'s moves for this many seconds '
+    'instead of --mcts-samples samples.')
+parser.add_argument(
+    '--mcts-depth', type=int, default=None,
+    help='Stop the mcts opponent\'s rollouts after this many turns and score '
+    'the state they reach with --mcts-evaluator.')
+parser.add_argument(
+    '--mcts-evaluator', type=str, default='hits',
+    choices=('hits', 'solved') + tuple(game_configs),
+    help='How to score the states truncated rollouts stop in: hits remaining, '
+    'the solved values, or the solved values of another game mode.')
+parser.add_argument(
+    '--seed', type=int, default=None,
+    help='Seed for the random number generator used to sample actions.')
+parser.add_argument(
+    '--successor-table', action='store_true',
+    help='Use the precomputed successor table for best response payoffs.')
+parser.add_argument(
+    '--best-response-table', action='store_true',
+    help='Play the best response opponent from the table saved by '
+    'b4_best_response.')
+parser.add_argument(
+    '--server', type=str, default=None,
+    help='Test the solution served by a b4_policy_server at this address '
+    'instead of loading it.')
+parser.add_argument(
+    '--exact', action='store_true',
+    help='Compute the exact outcome probabilities instead of playing games.  '
+    'Only for opponents that are stationary policies.')
 
 def test_solve(
+    config=None,
     opponent='random',
     games=10000,
     mcts_samples=10000,
+    mcts_procs=1,
+    mcts_seconds=None,
+    mcts_depth=None,
+    mcts_evaluator='hits',
+    successor_table=False,
+    seed=None,
+    exact=False,
+    best_response_table=False,
+    server=None,
 ):
     
-    # load the agent
-    agent_path = './solutions/%s_final.pkl'%game_mode
-    agent = SolvedAgent(agent_path)
+    if config is None:
+        config = default_config
     
-    # load the opponent
-    if opponent == 'random':
-        opponent_agent = RandomAgent()
-    elif opponent == 'best_response':
-        opponent_agent = BestResponseAgent(agent)
-    elif opponent == 'argmax_counter':
-        opponent_agent = ArgmaxCounterAgent(agent)
-    elif opponent == 'solved':
-        opponent_agent = SolvedAgent(agent_path)
-    elif opponent == 'mcts':
-        opponent_agent = MCTSAgent(mcts_samples)
+    # check the options before building any agents, since some of them start
+    # worker processes or connect to a server
+    if opponent not in opponents:
+        raise ValueError('unknown opponent %s'%opponent)
+    if exact and opponent == 'mcts':
+        raise ValueError('mcts is not a stationary policy')
+    if server is not None and opponent == 'best_response' and (
+        not best_response_table):
+        raise ValueError('the best_response opponent needs '
+            '--best-response-table when testing through a server')
     
-    results = []
-    for i in tqdm.tqdm(range(games)):
-        state = State()
-        while not state.terminal:
-            
-            # pick an action for the agent
-            p1_action = agent.play(state)
-            
-            # pick an action for the opponent
-            opposite_state = State(state.p2, state.p1)
-            p2_action = opponent_agent.play(opposite_state)
-            
-            state = state.transition((p1_action, p2_action))
+    agent = None
+    opponent_agent = None
+    try:
+        # load the agent
+        agent_path = './solutions/%s_final.b4s'%config.name
+        if server is not None:
+            agent = PolicyServerAgent(server, config=config)
+        else:
+            agent = SolvedAgent(agent_path, config=config)
+        
+        # load the successor table
+        successors = None
+        if successor_table:
+            successors = load_successor_table(
+                './solutions/%s_successors.npy'%config.name)
+        
+        # load the opponent
+        if opponent == 'random':
+            opponent_agent = RandomAgent()
+        elif opponent == 'best_response':
+            table = None
+            if best_response_table:
+                table = best_response_path(config)
+            opponent_agent = BestResponseAgent(
+                agent, successors=successors, table=table)
+        elif opponent == 'argmax_counter':
+            opponent_agent = ArgmaxCounterAgent(agent)
+        elif opponent == 'solved':
+            opponent_agent = SolvedAgent(agent_path, config=config)
+        elif opponent == 'mcts':
+            opponent_agent = MCTSAgent(
+                mcts_samples,
+                config=config,
+                num_procs=mcts_procs,
+                seconds=mcts_seconds,
+                seed=seed,
+                rollout_depth=mcts_depth,
+                evaluator=(None if mcts_depth is None
+                    else make_evaluator(mcts_evaluator, config)),
+            )
         
-        results.append(state.value)
+        if exact:
+            wins, draws, losses = evaluate(
+                agent, opponent_agent, config=config, successors=successors)
+            win, loss, draw = config.payoffs
+            print('Win Rate: %.06f'%(wins + 0.5*draws))
+            print('Value: %.06f'%(wins*win + draws*draw + losses*loss))
+            print('Wins: %.06f, Draws: %.06f, Losses: %.06f'%(
+                wins, draws, losses))
+            return
+        
+        # play all of the games in lockstep batches
+        results = simulate(
+            agent,
+            opponent_agent,
+            games,
+            config=config,
+            rng=numpy.random.default_rng(seed),
+            progress=True,
+        )
+    finally:
+        # stop any mcts workers and disconnect from the server
+        for a in (opponent_agent, agent):
+            if hasattr(a, 'close'):
+                a.close()
 
-    average_value = (sum(results)/len(results) - 0.5) * (1./0.8) + 0.5
+    win, loss, draw = config.payoffs
+    average_value = (results.mean() - loss) / (win - loss)
     print('Win Rate: %.06f'%average_value)
     
-    wins = sum([r > 0.6 for r in results])
-    losses = sum([r < 0.4 for r in results])
+    wins = int(numpy.sum(results == win))
+    losses = int(numpy.sum(results == loss))
     draws = len(results) - wins - losses
     print('Wins: %i, Draws: %i, Losses: %i'%(wins, draws, losses))
-    
-    breakpoint()
 
 def test_solve_commandline():
     # parse args
     args = parser.parse_args()
     
     test_solve(
+        config=game_configs[args.mode],
         opponent=args.opponent,
         games=args.games,
         mcts_samples=args.mcts_samples,
+        mcts_procs=args.mcts_procs,
+        mcts_seconds=args.mcts_seconds,
+        mcts_depth=args.mcts_depth,
+        mcts_evaluator=args.mcts_evaluator,
+        successor_table=args.successor_table,
+        seed=args.seed,
+        exact=args.exact,
+        best_response_table=args.best_response_table,
+        server=args.server,
     )
 
 if __name__ == '__main__':
-    test_solve_from_args()
+    test_solve_commandline()
@@ -0,0 +1,440 @@
+import time
+import json
+import queue
+import random
+import argparse
+import itertools
+import statistics
+import multiprocessing
+
+import numpy
+
+import tqdm
+
+from black_belt.bodega_brawl import game_mode, game_configs, default_config
+from black_belt.game_statistics import load_successor_table
+from black_belt.agent import (
+    SolvedAgent,
+    RandomAgent,
+    BestResponseAgent,
+    ArgmaxCounterAgent,
+    MCTSAgent,
+)
+from black_belt.simulate import simulate
+from black_belt.best_response import best_response_path
+from black_belt.mcts import make_evaluator
+from black_belt.solution_file import load_solution
+from black_belt.shared_solution import SharedSolution
+
+'''
+Plays a round-robin tournament between a set of agents.  Every pair of
+agents plays a matchup, and each matchup is split into blocks of games that
+are played on a pool of worker processes.  Every block draws its random
+numbers from its own stream, derived from the tournament seed and the
+block's position in the tournament, so the results do not depend on how
+many processes there are or which worker plays which block.
+
+Blocks are merged into the running totals of their matchup in order as they
+arrive, and the confidence intervals are updated after every block.  If a
+precision is given, a matchup stops once the confidence interval of its score
+is narrower than that, and any of its blocks that were already running past
+that point are discarded.  This keeps early stopping reproducible as well.
+
+A game's score is 1 for a win, 0.5 for a draw and 0 for a loss, from the
+point of view of the first agent in the matchup.  The output includes a
+Wilson interval for the probability of a win, a bootstrap interval for the
+mean score and the number of games played per second of worker time.
+'''
+
+agent_names = ('solved', 'random', 'best_response', 'argmax_counter', 'mcts')
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--mode', type=str, default=game_mode, choices=tuple(game_configs),
+    help='The game configuration to play.')
+parser.add_argument(
+    '--agents', type=str, nargs='+', choices=agent_names,
+    default=['solved', 'random', 'best_response', 'argmax_counter'],
+    help='The agents in the tournament.  Every pair plays a matchup.')
+parser.add_argument(
+    '--games', type=int, default=100000,
+    help='The maximum number of games in each matchup.')
+parser.add_argument(
+    '--block-size', type=int, default=5000,
+    help='The number of games a worker plays at a time.')
+parser.add_argument('--num-procs', type=int, default=8)
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument(
+    '--precision', type=float, default=None,
+    help='Stop a matchup once the half-width of the confidence interval of '
+    'its score is at most this.')
+parser.add_argument('--confidence', type=float, default=0.95)
+parser.add_argument('--bootstrap-samples', type=int, default=2000)
+parser.add_argument('--mcts-samples', type=int, default=1000)
+parser.add_argument(
+    '--mcts-depth', type=int, default=None,
+    help='Stop the mcts agent\'s rollouts after this many turns and score '
+    'the state they reach with --mcts-evaluator.')
+parser.add_argument(
+    '--mcts-evaluator', type=str, default='hits',
+    choices=('hits', 'solved') + tuple(game_configs),
+    help='How to score the states truncated rollouts stop in: hits remaining, '
+    'the solved values, or the solved values of another game mode.')
+parser.add_argument(
+    '--successor-table', action='store_true',
+    help='Use the precomputed successor table for best response payoffs.')
+parser.add_argument(
+    '--best-response-table', action='store_true',
+    help='Play the best response agent from the table saved by '
+    'b4_best_response.')
+parser.add_argument(
+    '--shared-solution', action='store_true',
+    help='Load the solution once into shared memory for all of the workers '
+    'instead of having each worker load it.')
+parser.add_argument(
+    '--output', type=str, default=None,
+    help='Write the final results to this json file.')
+
+def wilson_interval(successes, n, confidence=0.95):
+    '''
+    The Wilson score interval for a binomial proportion.
+    '''
+    if n == 0:
+        return 0., 1.
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence/2.)
+    p = successes / n
+    denominator = 1. + z**2/n
+    center = (p + z**2/(2*n)) / denominator
+    half_width = z * (p*(1.-p)/n + z**2/(4*n**2))**0.5 / denominator
+    return center - half_width, center + half_width
+
+def bootstrap_interval(
+    wins,
+    draws,
+    losses,
+    rng,
+    samples=2000,
+    confidence=0.95,
+):
+    '''
+    A percentile bootstrap interval for the mean score, resampling the games
+    from their win/draw/loss counts.
+    '''
+    n = wins + draws + losses
+    if n == 0:
+        return 0., 1.
+    counts = rng.multinomial(n, numpy.array([wins, draws, losses]) / n, samples)
+    scores = (counts[:,0] + 0.5*counts[:,1]) / n
+    alpha = (1. - confidence) / 2.
+    low, high = numpy.quantile(scores, [alpha, 1. - alpha])
+    return float(low), float(high)
+
+# each worker keeps the solved agent, which is read only, between blocks
+worker_state = {}
+
+def init_worker(
+    config,
+    mcts_samples,
+    mcts_depth,
+    mcts_evaluator,
+    successor_table,
+    best_response_table,
+    solution_handle,
+):
+    worker_state['config'] = config
+    worker_state['mcts_samples'] = mcts_samples
+    worker_state['mcts_depth'] = mcts_depth
+    worker_state['mcts_evaluator'] = None
+    if mcts_depth is not None:
+        worker_state['mcts_evaluator'] = make_evaluator(mcts_evaluator, config)
+    worker_state['successors'] = None
+    if successor_table:
+        worker_state['successors'] = load_successor_table(
+            './solutions/%s_successors.npy'%config.name)
+    if solution_handle is not None:
+        worker_state['solved'] = SolvedAgent(solution=solution_handle.attach())
+    else:
+        worker_state['solved'] = SolvedAgent(config=config)
+    worker_state['best_response_table'] = None
+    if best_response_table:
+        worker_state['best_response_table'] = best_response_path(config)
+
+def make_agent(name):
+    '''
+    Builds an agent by name in a worker process.  Agents other than the
+    solved agent are rebuilt for every block so that no state carries over
+    from one block to the next.
+    '''
+    solved = worker_state['solved']
+    if name == 'solved':
+        return solved
+    elif name == 'random':
+        return RandomAgent()
+    elif name == 'best_response':
+        return BestResponseAgent(
+            solved,
+            successors=worker_state['successors'],
+            table=worker_state['best_response_table'],
+        )
+    elif name == 'argmax_counter':
+        return ArgmaxCounterAgent(solved)
+    elif name == 'mcts':
+        return MCTSAgent(
+            worker_state['mcts_samples'],
+            config=worker_state['config'],
+            rollout_depth=worker_state['mcts_depth'],
+            evaluator=worker_state['mcts_evaluator'],
+        )
+    raise ValueError('unknown agent %s'%name)
+
+def play_block(task):
+    '''
+    Plays one block of games and returns the win, draw and loss counts of the
+    first agent along with the time it took.
+    '''
+    seed, matchup, block, agent_name, opponent_name, games = task
+    seed_sequence = numpy.random.SeedSequence(seed, spawn_key=(matchup, block))
+    rng = numpy.random.default_rng(seed_sequence)
+
+    # some agents sample from python's global random module
+    random.seed(int(seed_sequence.generate_state(1)[0]))
+
+    start_time = time.time()
+    config = worker_state['config']
+    values = simulate(
+        make_agent(agent_name),
+        make_agent(opponent_name),
+        games,
+        config=config,
+        rng=rng,
+    )
+    win, loss, draw = config.payoffs
+    wins = int(numpy.sum(values == win))
+    losses = int(numpy.sum(values == loss))
+    draws = games - wins - losses
+    return matchup, block, wins, draws, losses, time.time() - start_time
+
+class MatchupResults:
+    def __init__(self, agent_name, opponent_name):
+        self.agent_name = agent_name
+        self.opponent_name = opponent_name
+        self.wins = 0
+        self.draws = 0
+        self.losses = 0
+        self.seconds = 0.
+        self.blocks = 0
+        self.finished = False
+
+    @property
+    def games(self):
+        return self.wins + self.draws + self.losses
+
+    @property
+    def score(self):
+        return (self.wins + 0.5*self.draws) / max(self.games, 1)
+
+    def merge(self, wins, draws, losses, seconds):
+        self.wins += wins
+        self.draws += draws
+        self.losses += losses
+        self.seconds += seconds
+        self.blocks += 1
+
+    def summary(self, rng, confidence, bootstrap_samples):
+        return {
+            'agent' : self.agent_name,
+            'opponent' : self.opponent_name,
+            'games' : self.games,
+            'wins' : self.wins,
+            'draws' : self.draws,
+            'losses' : self.losses,
+            'score' : self.score,
+            'score_interval' : bootstrap_interval(
+                self.wins,
+                self.draws,
+                self.losses,
+                rng,
+                samples=bootstrap_samples,
+                confidence=confidence,
+            ),
+            'win_interval' : wilson_interval(
+                self.wins, self.games, confidence=confidence),
+            'games_per_second' : self.games / max(self.seconds, 1e-9),
+        }
+
+def format_summary(summary):
+    return (
+        '%s vs %s: Wins: %i, Draws: %i, Losses: %i, '
+        'Score: %.04f [%.04f, %.04f], Win Rate: [%.04f, %.04f], '
+        '%.0f games/s'
+    )%(
+        summary['agent'],
+        summary['opponent'],
+        summary['wins'],
+        summary['draws'],
+        summary['losses'],
+        summary['score'],
+        *summary['score_interval'],
+        *summary['win_interval'],
+        summary['games_per_second'],
+    )
+
+def tournament(
+    config=None,
+    agents=('solved', 'random', 'best_response', 'argmax_counter'),
+    games=100000,
+    block_size=5000,
+    num_procs=8,
+    seed=0,
+    precision=None,
+    confidence=0.95,
+    bootstrap_samples=2000,
+    mcts_samples=1000,
+    mcts_depth=None,
+    mcts_evaluator='hits',
+    successor_table=False,
+    best_response_table=False,
+    shared_solution=False,
+):
+    if config is None:
+        config = default_config
+
+    # every pair of agents plays a matchup made of blocks of games
+    pairs = list(itertools.combinations(agents, 2))
+    results = [MatchupResults(a, b) for a, b in pairs]
+    num_blocks = -(-games // block_size)
+    def block_games(block):
+        return min(block_size, games - block * block_size)
+
+    # the bootstrap intervals get their own random stream for each matchup
+    def interval_rng(matchup, blocks):
+        return numpy.random.default_rng(numpy.random.SeedSequence(
+            seed, spawn_key=(matchup, num_blocks, blocks)))
+
+    def summaries():
+        return [
+            r.summary(interval_rng(m, r.blocks), confidence, bootstrap_samples)
+            for m, r in enumerate(results)
+        ]
+
+    # Blocks are submitted round robin between the matchups that are still
+    # running, keeping twice as many blocks in flight as there are workers.
+    # Blocks that arrive out of order wait in pending until the blocks
+    # before them have been merged.
+    context = multiprocessing.get_context(None)
+    shared = None
+    solution_handle = None
+    if shared_solution:
+        shared = SharedSolution(load_solution(
+            './solutions/%s_final.b4s'%config.name, config=config))
+        solution_handle = shared.handle()
+    pool = context.Pool(
+        num_procs,
+        initializer=init_worker,
+        initargs=(
+            config,
+            mcts_samples,
+            mcts_depth,
+            mcts_evaluator,
+            successor_table,
+            best_response_table,
+            solution_handle,
+        ),
+    )
+    next_block = [0] * len(pairs)
+    pending = [{} for _ in pairs]
+    outstanding = 0
+    completed = queue.Queue()
+    progress = tqdm.tqdm(total=games * len(pairs))
+    start_time = time.time()
+    try:
+        while True:
+            while outstanding < 2*num_procs:
+                running = [
+                    m for m, r in enumerate(results)
+                    if not r.finished and next_block[m] < num_blocks
+                ]
+                if not running:
+                    break
+                m = min(running, key=lambda m: next_block[m])
+                block = next_block[m]
+                next_block[m] += 1
+                task = (seed, m, block, *pairs[m], block_games(block))
+                pool.apply_async(
+                    play_block,
+                    (task,),
+                    callback=completed.put,
+                    error_callback=completed.put,
+                )
+                outstanding += 1
+            if not outstanding:
+                break
+            
+            # merge results in block order as they become available
+            result = completed.get()
+            outstanding -= 1
+            if isinstance(result, BaseException):
+                raise result
+            m, block, wins, draws, losses, seconds = result
+            pending[m][block] = wins, draws, losses, seconds
+            matchup = results[m]
+            while not matchup.finished and matchup.blocks in pending[m]:
+                block_results = pending[m].pop(matchup.blocks)
+                matchup.merge(*block_results)
+                progress.update(sum(block_results[:3]))
+                if matchup.blocks == num_blocks:
+                    matchup.finished = True
+                elif precision is not None:
+                    low, high = bootstrap_interval(
+                        matchup.wins,
+                        matchup.draws,
+                        matchup.losses,
+                        interval_rng(m, matchup.blocks),
+                        samples=bootstrap_samples,
+                        confidence=confidence,
+                    )
+                    if (high - low) / 2. <= precision:
+                        matchup.finished = True
+                        progress.total -= games - matchup.games
+                        progress.refresh()
+    finally:
+        pool.terminate()
+        pool.join()
+        if shared is not None:
+            shared.close()
+        progress.close()
+
+    elapsed = time.time() - start_time
+    total_games = sum(r.games for r in results)
+    print('Played %i games in %.02fs (%.0f games/s)'%(
+        total_games, elapsed, total_games / max(elapsed, 1e-9)))
+    final_summaries = summaries()
+    for summary in final_summaries:
+        print(format_summary(summary))
+    return final_summaries
+
+def tournament_commandline():
+    args = parser.parse_args()
+    summaries = tournament(
+        config=game_configs[args.mode],
+        agents=args.agents,
+        games=args.games,
+        block_size=args.block_size,
+        num_procs=args.num_procs,
+        seed=args.seed,
+        precision=args.precision,
+        confidence=args.confidence,
+        bootstrap_samples=args.bootstrap_samples,
+        mcts_samples=args.mcts_samples,
+        mcts_depth=args.mcts_depth,
+        mcts_evaluator=args.mcts_evaluator,
+        successor_table=args.successor_table,
+        best_response_table=args.best_response_table,
+        shared_solution=args.shared_solution,
+    )
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(summaries, f, indent=2)
+
+if __name__ == '__main__':
+    tournament_commandline()
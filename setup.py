@@ -23,6 +23,16 @@ setuptools.setup(
             'b4_play=black_belt.play:play_commandline',
             'b4_solve=black_belt.solve:solve_commandline',
             'b4_test_solve=black_belt.test_solve:test_solve_commandline',
+            'b4_tournament=black_belt.tournament:tournament_commandline',
+            'b4_best_response='
+                'black_belt.best_response:best_response_commandline',
+            'b4_exploitability='
+                'black_belt.exploitability:exploitability_commandline',
+            'b4_policy_server='
+                'black_belt.policy_server:policy_server_commandline',
+            'b4_benchmark=black_belt.benchmark:benchmark_commandline',
+            'b4_convert_solution='
+                'black_belt.solution_file:convert_solution_commandline',
         ]
     },
     classifiers = [